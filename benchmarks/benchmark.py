@@ -0,0 +1,307 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+Benchmarks dmenu-extended against generated home folders
+
+A synthetic tree of files and folders (with varied depth and fan-out and a
+few symlink loops), fake $PATH folders full of executables and a corpus of
+.desktop files are generated in a temporary folder which then serves as the
+home folder of the benchmarked runs. Every scenario is run in a subprocess
+of its own, so that its time and peak memory can be measured on their own:
+
+    build       a full cache build, as after installation
+    rebuild     a cache build with the folder manifest of the previous build
+    load        opening the packed cache and streaming it into the menu
+    filter      the ':' mode filtering of the cache for a set of queries
+    resolve     handle_command deciding what to do with a set of items
+    exclude     a full cache build with thousands of exclude_items and
+                ignore_folders, some of them found in the tree, which should
+                take about as long as build does (its peak memory includes
+                listing the tree to pick them)
+
+The menu is a stub script which reads everything it is given and picks
+nothing, and commands are never actually run.
+
+Usage:
+
+    python benchmarks/benchmark.py [--files 10000,100000] [--exclusions 5000] [--keep DIR] [--json FILE]
+"""
+from __future__ import print_function, unicode_literals
+import sys
+import os
+import json
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+scenarios = ['build', 'rebuild', 'load', 'filter', 'resolve', 'exclude']
+
+queries = ['pdf', 'notes', 'rpt', 'a', 'zzz', 'project/src']
+
+extensions = ['txt', 'pdf', 'py', 'md', 'png', 'jpg', 'html', 'mp3', 'o', 'log', '']
+
+words = ['alpha', 'beta', 'gamma', 'delta', 'project', 'notes', 'report', 'photos',
+         'music', 'src', 'lib', 'test', 'data', 'docs', 'build', 'config', 'main']
+
+
+def name(rng):
+    return rng.choice(words) + str(rng.randint(0, 999))
+
+
+def generate_tree(root, files, rng, files_per_folder=20, fanout=6):
+    """ Creates about files files beneath root, in folders of varying depth
+    and fan-out, with a symlink loop in one folder out of a hundred.
+    """
+    folders = [root]
+    queue = [root]
+    wanted = max(1, files // files_per_folder)
+    while len(folders) < wanted and len(queue) > 0:
+        parent = queue.pop(0)
+        for i in range(rng.randint(1, 2 * fanout)):
+            path = os.path.join(parent, name(rng) + '_' + str(len(folders)))
+            os.mkdir(path)
+            folders.append(path)
+            queue.append(path)
+            if rng.random() < 0.01:
+                os.symlink(parent, os.path.join(path, 'loop'))
+            if len(folders) == wanted:
+                break
+    created = 0
+    while created < files:
+        folder = folders[created % len(folders)]
+        extension = rng.choice(extensions)
+        filename = name(rng) + '_' + str(created) + ('.' + extension if extension else '')
+        open(os.path.join(folder, filename), 'w').close()
+        created += 1
+
+
+def generate_path(root, folders, binaries, rng):
+    paths = []
+    for i in range(folders):
+        path = os.path.join(root, 'bin' + str(i))
+        os.makedirs(path)
+        for j in range(binaries):
+            binary = os.path.join(path, name(rng))
+            with open(binary, 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(binary, 0o755)
+        paths.append(path)
+    return paths
+
+
+def generate_desktop_files(root, count, rng):
+    path = os.path.join(root, 'applications')
+    os.makedirs(path)
+    for i in range(count):
+        command = name(rng)
+        with open(os.path.join(path, command + '_' + str(i) + '.desktop'), 'w') as f:
+            f.write('[Desktop Entry]\n')
+            f.write('Type=Application\n')
+            f.write('Name=' + command.capitalize() + ' ' + str(i) + '\n')
+            f.write('Name[de]=' + command.upper() + '\n')
+            f.write('Exec=' + command + ' %U\n')
+            f.write('Terminal=' + ('true' if i % 10 == 0 else 'false') + '\n')
+            if i % 25 == 0:
+                f.write('NoDisplay=true\n')
+
+
+def generate(root, files, seed=1):
+    """ Generates a home folder with about files files, fake $PATH folders
+    and .desktop files beneath root.
+    """
+    rng = random.Random(seed)
+    tree = os.path.join(root, 'home', 'files')
+    os.makedirs(tree)
+    generate_tree(tree, files, rng)
+    generate_path(os.path.join(root, 'path'), 8, 250, rng)
+    generate_desktop_files(os.path.join(root, 'share'), 400, rng)
+
+    menu = os.path.join(root, 'menu')
+    with open(menu, 'w') as f:
+        f.write('#!/bin/sh\ncat > /dev/null\n')
+    os.chmod(menu, 0o755)
+
+
+def exclusions(tree, count):
+    """ Returns (exclude_items, ignore_folders) of count entries each for the
+    tree, up to half of them taken from the tree and the rest made up.
+    """
+    files = []
+    folders = []
+    for path, names, filenames in os.walk(tree):
+        names.sort()
+        folders.extend([os.path.join(path, x) for x in names])
+        files.extend([os.path.join(path, x) for x in sorted(filenames)])
+    rng = random.Random(1)
+    # At most a tenth of the leaf folders are ignored, so that the builds
+    # compared index much the same items
+    leaves = [x for x in folders if not any([os.path.isdir(os.path.join(x, y)) for y in os.listdir(x)])]
+    exclude_items = rng.sample(files, min(len(files) // 10, count // 2))
+    ignore_folders = rng.sample(leaves, min(len(leaves) // 10, count // 2))
+    for i in range(count - len(exclude_items)):
+        exclude_items.append(os.path.join(tree, 'missing', name(rng) + '_' + str(i) + '.txt'))
+    for i in range(count - len(ignore_folders)):
+        ignore_folders.append(os.path.join(tree, 'missing', name(rng) + '_' + str(i)))
+    return exclude_items, ignore_folders
+
+
+def environment(root, count=5000):
+    """ Returns the environment to run the scenarios in for the generated
+    folders beneath root, with count exclusions for the exclude scenario.
+    """
+    home = os.path.join(root, 'home')
+    tree = os.path.join(home, 'files')
+    menu = os.path.join(root, 'menu')
+    paths = sorted([os.path.join(root, 'path', x) for x in os.listdir(os.path.join(root, 'path'))])
+    env = dict(os.environ)
+    env.update({
+        'HOME': home,
+        'PATH': ':'.join(paths + ['/usr/bin', '/bin']),
+        'XDG_DATA_HOME': os.path.join(home, '.local', 'share'),
+        'XDG_DATADIRS': os.path.join(root, 'share'),
+        'BENCHMARK_TREE': tree,
+        'BENCHMARK_MENU': menu,
+        'BENCHMARK_EXCLUSIONS': str(count)
+    })
+    return env
+
+
+def peak_rss():
+    """ Returns the peak RSS of this process in kB """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == 'darwin':
+        return peak // 1024
+    return peak
+
+
+def measure(scenario, env):
+    """ Runs scenario in a subprocess, returning (seconds, peak RSS in kB,
+    wall clock seconds)
+    """
+    started = time.time()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--scenario', scenario],
+                               env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        print(output.decode('utf-8', 'replace'))
+        raise RuntimeError('The ' + scenario + ' scenario failed')
+    # The subprocess measures its own peak, as the rusage of a single child
+    # can not be had portably
+    result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+    return result['seconds'], result['peak_rss_kb'], time.time() - started
+
+
+def run_scenario(scenario):
+    """ Runs within the subprocess, printing the time taken as json """
+    sys.path.insert(0, repository)
+    import io
+    stdout = sys.stdout
+    sys.stdout = io.StringIO() if sys.version_info[0] > 2 else open(os.devnull, 'w')
+    import dmenu_extended
+    sys.stdout = stdout
+
+    prefs = dict(dmenu_extended.default_prefs)
+    prefs.update({
+        'menu': os.environ['BENCHMARK_MENU'],
+        'menu_arguments': [],
+        'watch_folders': [os.environ['BENCHMARK_TREE']],
+        'follow_symlinks': True,
+        'fileopener': 'true',
+        'filebrowser': 'true',
+        'webbrowser': 'true'
+    })
+    if scenario == 'exclude':
+        prefs['exclude_items'], prefs['ignore_folders'] = exclusions(os.environ['BENCHMARK_TREE'],
+                                                                     int(os.environ['BENCHMARK_EXCLUSIONS']))
+    with open(dmenu_extended.file_prefs, 'w') as f:
+        json.dump(prefs, f)
+
+    d = dmenu_extended.dmenu()
+    if scenario in ['build', 'exclude'] and os.path.exists(dmenu_extended.file_cache_manifest):
+        os.remove(dmenu_extended.file_cache_manifest)
+
+    if scenario == 'load':
+        started = time.time()
+        cache = d.cache_load_packed()
+        d.cache_overlay(cache)
+        cache.promote(d.history_top())
+        try:
+            d.menu(cache)
+        except SystemExit:
+            pass
+    elif scenario == 'filter':
+        cache = d.cache_load_packed()
+        started = time.time()
+        for query in queries:
+            d.cache_filter(cache, query)
+            d.cache_filter(cache, query, [dmenu_extended.packed_cache.FOLDER, dmenu_extended.packed_cache.FILE])
+    elif scenario == 'resolve':
+        cache = d.cache_load_packed()
+        items = list(cache.items())
+        items = random.Random(1).sample(items, min(200, len(items)))
+        d.execute = lambda command, fork=None: 0
+        d.open_terminal = lambda command, hold=False, direct=False: None
+        d.load_preferences()
+        started = time.time()
+        for item in items:
+            if item.startswith(d.prefs['indicator_submenu']) or item.startswith(d.prefs['indicator_alias']):
+                continue
+            dmenu_extended.handle_command(d, item)
+    else:
+        started = time.time()
+        d.cache_build()
+
+    seconds = time.time() - started
+    print(json.dumps({'seconds': seconds, 'peak_rss_kb': peak_rss()}))
+
+
+def main(args):
+    if '--scenario' in args:
+        run_scenario(args[args.index('--scenario') + 1])
+        return
+
+    sizes = [10000, 100000]
+    if '--files' in args:
+        sizes = [int(x) for x in args[args.index('--files') + 1].split(',')]
+    count = 5000
+    if '--exclusions' in args:
+        count = int(args[args.index('--exclusions') + 1])
+    keep = None
+    if '--keep' in args:
+        keep = args[args.index('--keep') + 1]
+
+    results = []
+    print('files'.rjust(9) + '  ' + 'scenario'.ljust(8) + 'seconds'.rjust(10) + 'peak MB'.rjust(10))
+    for files in sizes:
+        if keep is not None:
+            root = os.path.join(keep, str(files))
+            if os.path.exists(root) == False:
+                generate(root, files)
+        else:
+            root = tempfile.mkdtemp(prefix='dmenu-extended-benchmark')
+            generate(root, files)
+        try:
+            env = environment(root, count)
+            for scenario in scenarios:
+                seconds, rss, wall = measure(scenario, env)
+                results.append({'files': files, 'scenario': scenario, 'seconds': seconds,
+                                'wall_seconds': wall, 'peak_rss_kb': rss})
+                print(str(files).rjust(9) + '  ' + scenario.ljust(8) +
+                      ('%.3f' % seconds).rjust(10) + ('%.1f' % (rss / 1024.0)).rjust(10))
+        finally:
+            if keep is None:
+                shutil.rmtree(root)
+
+    if '--json' in args:
+        with open(args[args.index('--json') + 1], 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,9 +4,29 @@ import sys
 import os
 import subprocess
 import signal
+import stat
 import json
+import atexit
+import binascii
+import bisect
 import codecs
+import errno
+import fcntl
+import hashlib
+import heapq
+import itertools
 import locale
+import mmap
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from multiprocessing.pool import ThreadPool
 
 # Python 3 urllib import with Python 2 fallback
 try:
@@ -14,6 +34,28 @@ try:
 except:
     import urllib2
 
+# Python 3 http.client and urllib.parse imports with Python 2 fallbacks
+try:
+    import http.client as httplib
+    from urllib.parse import urljoin, urlparse
+except ImportError:
+    import httplib
+    from urlparse import urljoin, urlparse
+
+# Python 3.5+ provides os.scandir, fall back to the scandir package (or to
+# os.listdir when neither is available)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# When this module finished importing, the end of the startup phase of a
+# launch_trace
+time_loaded = time.time()
+
 # Find out the system's favouite encoding
 system_encoding = locale.getpreferredencoding()
 
@@ -21,6 +63,8 @@ path_base = os.path.expanduser('~') + '/.config/dmenu-extended'
 path_cache = path_base + '/cache'
 path_prefs = path_base + '/config'
 path_plugins = path_base + '/plugins'
+path_plugins_quarantine = path_base + '/plugins_quarantine'
+path_cache_http = path_cache + '/http'
 
 file_prefs = path_prefs + '/dmenuExtended_preferences.txt'
 file_cache = path_cache + '/dmenuExtended_all.txt'
@@ -29,7 +73,22 @@ file_cache_files = path_cache + '/dmenuExtended_files.txt'
 file_cache_folders = path_cache + '/dmenuExtended_folders.txt'
 file_cache_aliases = path_cache + '/dmenuExtended_aliases.txt'
 file_cache_aliasesLookup = path_cache + '/dmenuExtended_aliases_lookup.json'
+file_cache_aliases_store = path_cache + '/dmenuExtended_aliases.sqlite'
 file_cache_plugins = path_cache + '/dmenuExtended_plugins.txt'
+file_cache_plugins_manifest = path_cache + '/dmenuExtended_plugins_manifest.json'
+file_cache_manifest = path_cache + '/dmenuExtended_manifest.json'
+file_cache_packed = path_cache + '/dmenuExtended_cache.bin'
+file_cache_history = path_cache + '/dmenuExtended_history.json'
+file_cache_desktop = path_cache + '/dmenuExtended_desktop.json'
+file_cache_path_index = path_cache + '/dmenuExtended_path_index.json'
+file_cache_store_log = path_cache + '/dmenuExtended_store_log.txt'
+file_cache_store_index = path_cache + '/dmenuExtended_store_index.json'
+file_cache_stats = path_cache + '/dmenuExtended_build_stats.json'
+file_cache_trace = path_cache + '/dmenuExtended_trace.log'
+file_cache_generation = path_cache + '/dmenuExtended_generation.json'
+file_cache_lock = path_cache + '/dmenuExtended.lock'
+file_cache_status = path_cache + '/dmenuExtended_rebuild_status.json'
+file_server_socket = os.environ.get('XDG_RUNTIME_DIR', path_cache) + '/dmenu-extended.sock'
 # file_shCmd = '~/.dmenuEextended_shellCommand.sh'
 
 default_prefs = {
@@ -65,9 +124,31 @@ default_prefs = {
     "watch_folders": ["~/"],            # Base folders through which to search
     "follow_symlinks": False,           # Follow links to other locations
     "ignore_folders": [],               # Folders to exclude from the search
+    "ignore_patterns": [],              # gitignore style patterns of files and folders to exclude
+    "use_ignore_files": False,          # Honour .gitignore and .ignore files found while scanning
+    "scan_workers": 4,                  # Number of threads used to scan the watch folders
+    "rebuild_niceness": 19,             # Niceness of rebuilds run in the background
+    "build_run_size": 20000,            # Items sorted in memory at a time while building the cache
+    "incremental_rebuild": True,        # Only re-list folders that changed since the last scan
+    "daemon_debounce": 2,               # Seconds of quiet before the daemon writes its changes
     "scan_hidden_folders": False,       # Enter hidden folders while scanning for items
     "include_hidden_files": False,      # Include hidden files in the cache
     "include_hidden_folders": False,    # Include hidden folders in the cache
+    "frecency_ranking": True,           # Show frequently and recently launched items first
+    "frecency_half_life": 168,          # Hours after which the weight of a launch has halved
+    "frecency_items": 20,               # Number of top ranked items moved to the front at launch
+    "fuzzy_matching": False,            # Rank the items offered by the ':' modes with the fuzzy matcher
+    "fuzzy_results": 50,                # Number of fuzzy matches offered
+    "store_log_compact": 50,            # Number of store edits logged before they are folded into the cache
+    "trace_launches": False,            # Log how long each phase of a launch takes
+    "trace_samples": 1000,              # Number of launches kept in the trace log
+    "plugin_timeout": 300,              # Seconds a plugin may run, menus included, before it is stopped (0 for no limit)
+    "plugin_import_timeout": 10,        # Seconds a plugin may take to load before it is quarantined
+    "plugin_memory_limit": 1024,        # Megabytes of memory a plugin may use (0 for no limit)
+    "plugins_index_url": "https://raw.githubusercontent.com/markjones112358/dmenu-extended-plugins/master/plugins_index.json",
+    "http_timeout": 10,                 # Seconds to wait on the plugin repository before giving up
+    "http_max_age": 3600,               # Seconds downloads are reused from the cache before being revalidated
+    "http_stale_while_revalidate": True, # Show the cached plugin list at once and refresh it in the background
     "include_items": [],                # Extra items to display - manually added
     "exclude_items": [],                # Items to hide - manually hidden
     "include_binaries": True,
@@ -103,99 +184,2326 @@ default_prefs = {
 }
 
 
-def setup_user_files():
-    """ Returns nothing
+def setup_user_files():
+    """ Returns nothing
+
+    Create a path for the users prefs files to be stored in their
+    home folder. Create default config files and place them in the relevant
+    directory.
+    """
+
+    print('Setting up dmenu-extended prefs files...')
+
+    try:
+        os.makedirs(path_plugins)
+        print('Plugins directory created')
+    except OSError:
+        print('Plugins directory exists - skipped')
+
+    try:
+        os.makedirs(path_cache)
+        print('Cache directory created')
+    except OSError:
+        print('Cache directory exists - skipped')
+
+    try:
+        os.makedirs(path_prefs)
+        print('prefs directory created')
+    except OSError:
+        print('prefs directory exists - skipped')
+
+    # If relevant binaries exist, swap them out for the more appropriate items
+
+    # It has been decided against setting gnome-open or gvfs-open as a default
+    # file handler to prevent intermittent failure to open a text editor
+    # required to edit the configuration file.
+
+    # if os.path.exists('/usr/bin/gnome-open'):
+    #     default_prefs['fileopener'] = 'gnome-open'
+    #     default_prefs['webbrowser'] = 'gnome-open'
+    #     default_prefs['filebrowser'] = 'gnome-open'
+    if os.path.exists('/usr/bin/gnome-terminal'):
+        default_prefs['terminal'] = 'gnome-terminal'
+    if os.path.exists('/usr/bin/urxvt'):
+        default_prefs['terminal'] = 'urxvt'
+
+    # Dump the prefs file
+    if os.path.exists(file_prefs) == False:
+        with open(file_prefs,'w') as f:
+            json.dump(default_prefs, f, sort_keys=True, indent=4)
+        print('Preferences file created at: ' + file_prefs)
+    else:
+        print('Existing preferences file found, will not overwrite.')
+
+    # Create package __init__ - for easy access to the plugins
+    with open(path_plugins + '/__init__.py','w') as f:
+        f.write('import os\n')
+        f.write('import glob\n')
+        f.write('__all__ = [ os.path.basename(f)[:-3] for f in glob.glob(os.path.dirname(__file__)+"/*.py")]')
+
+
+if (os.path.exists(path_plugins + '/__init__.py') and
+    os.path.exists(file_cache) and
+    os.path.exists(file_prefs)):
+    sys.path.append(path_base)
+else:
+    setup_user_files()
+    sys.path.append(path_base)
+
+import plugins
+
+
+class plugin_host(object):
+    """ Runs plugin code in a forked worker process
+
+    The worker is stopped (along with the menus it opened) after timeout
+    seconds and, where the resource module is available, may use at most
+    memory megabytes of address space; 0 lifts either limit. Whatever the
+    call returns comes back over a pipe as json, so a plugin which hangs,
+    crashes or runs out of memory cannot take the launcher with it.
+
+    Commands the plugin launches through dmenu.system are started without
+    the limit, in a session of their own, so that they outlive the worker.
+    """
+
+    # Set within a worker, holding the address space limit to give back to
+    # the commands it launches
+    in_worker = False
+    released_limit = None
+
+    def __init__(self, timeout=0, memory=0, debug=False):
+        self.timeout = timeout
+        self.memory = memory
+        self.debug = debug
+
+
+    def limit(self):
+        try:
+            import resource
+        except ImportError:
+            return
+        if self.memory > 0:
+            # Only the soft limit is lowered, so that it can be raised again
+            # for the commands launched
+            size = self.memory * 1024 * 1024
+            soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+            plugin_host.released_limit = (soft, hard)
+            if hard != resource.RLIM_INFINITY:
+                size = min(size, hard)
+            resource.setrlimit(resource.RLIMIT_AS, (size, hard))
+
+
+    @staticmethod
+    def release():
+        """ Undoes the worker's limits and process group, for a command it
+        launches, in the command's process before it is executed
+        """
+        os.setsid()
+        if plugin_host.released_limit is not None:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, plugin_host.released_limit)
+
+
+    def call(self, function, *args):
+        """ Returns (True, what function(*args) returned) or, should it fail
+        or run out of time, (False, the reason)
+        """
+        reader, writer = os.pipe()
+        # Commands started by the plugin must not hold the pipe open
+        fcntl.fcntl(writer, fcntl.F_SETFD, fcntl.fcntl(writer, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        pid = os.fork()
+        if pid == 0:
+            os.close(reader)
+            os.setpgid(0, 0)
+            plugin_host.in_worker = True
+            try:
+                self.limit()
+                result = {'ok': True, 'value': function(*args)}
+            except SystemExit:
+                result = {'ok': True, 'value': None}
+            except Exception as e:
+                result = {'ok': False, 'value': type(e).__name__ + ': ' + str(e)}
+            try:
+                data = json.dumps(result)
+            except (TypeError, ValueError):
+                data = json.dumps({'ok': True, 'value': None})
+            data = data.encode('utf-8')
+            while len(data) > 0:
+                data = data[os.write(writer, data):]
+            sys.stdout.flush()
+            os._exit(0)
+
+        os.close(writer)
+        return self.collect(pid, reader)
+
+
+    def collect(self, pid, reader):
+        import select
+        deadline = None
+        if self.timeout > 0:
+            deadline = time.time() + self.timeout
+        chunks = []
+        try:
+            while True:
+                wait = None
+                if deadline is not None:
+                    wait = max(0, deadline - time.time())
+                if len(select.select([reader], [], [], wait)[0]) == 0:
+                    self.stop(pid)
+                    return False, 'Stopped after running for %g seconds' % self.timeout
+                chunk = os.read(reader, 65536)
+                if len(chunk) == 0:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(reader)
+
+        status = self.wait(pid)
+        try:
+            result = json.loads(b''.join(chunks).decode('utf-8'))
+        except ValueError:
+            return False, 'Exited without a result (status ' + str(status) + ')'
+        return result['ok'], result['value']
+
+
+    def stop(self, pid):
+        if self.debug:
+            print('Stopping plugin worker ' + str(pid))
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.wait(pid)
+
+
+    def wait(self, pid):
+        # The launcher server ignores SIGCHLD, the kernel then reaps the
+        # worker itself
+        try:
+            return os.waitpid(pid, 0)[1]
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+        return None
+
+
+def quarantine_plugin(plugin, reason, debug=False):
+    """ Moves a plugin which failed to load out of the plugins folder,
+    recording the reason next to it
+    """
+    if os.path.exists(path_plugins_quarantine) == False:
+        os.makedirs(path_plugins_quarantine)
+    source = path_plugins + '/' + plugin + '.py'
+    if os.path.exists(source):
+        os.rename(source, path_plugins_quarantine + '/' + plugin + '.py')
+    with codecs.open(path_plugins_quarantine + '/' + plugin + '.txt', 'w', encoding=system_encoding) as f:
+        f.write(reason + '\n')
+    if debug:
+        print('!! Plugin ' + plugin + ' was quarantined in ' + path_plugins_quarantine + ': ' + reason)
+
+
+def probe_plugin(plugin):
+    __import__('plugins.' + plugin)
+    loaded = sys.modules['plugins.' + plugin].extension()
+    return {'title': loaded.title,
+            'is_submenu': bool(getattr(loaded, 'is_submenu', False))}
+
+
+def load_plugin(plugin, debug=False):
+    """ Imports a single plugin module and returns an instance of its
+    extension, or None (after quarantining the plugin) if it fails to load
+    """
+    try:
+        __import__('plugins.' + plugin)
+        loaded = sys.modules['plugins.' + plugin].extension()
+        if debug:
+            loaded.debug = True
+            print('Loaded plugin ' + plugin)
+        return loaded
+    except Exception as e:
+        if debug:
+            print('Error loading plugin ' + plugin)
+            print(str(e))
+        quarantine_plugin(plugin, type(e).__name__ + ': ' + str(e), debug)
+        return None
+
+
+class probed_plugin(object):
+    """ Stands in for a plugin that loaded in a worker of a plugin_host,
+    holding the title and submenu flag found there
+
+    The plugin is only imported into this process when anything else of it
+    is needed, which plugin_run does within a worker of its own.
+    """
+
+    def __init__(self, name, title, is_submenu, debug=False):
+        self.name = name
+        self.title = title
+        self.is_submenu = is_submenu
+        self.loaded_debug = debug
+        self.loaded = None
+
+
+    def __getattr__(self, attribute):
+        if attribute in ['name', 'loaded', 'loaded_debug'] or attribute.startswith('__'):
+            raise AttributeError(attribute)
+        if self.loaded is None:
+            self.loaded = load_plugin(self.name, self.loaded_debug)
+            if self.loaded is None:
+                raise ImportError(self.name + ' failed to load and was moved to ' + path_plugins_quarantine)
+        return getattr(self.loaded, attribute)
+
+
+def load_plugins(debug=False, host=None):
+    """ Loads every plugin, first trying each in a worker of host (when
+    given) so that a plugin which hangs or crashes while loading is
+    quarantined, and one which loads is not imported here at all (see
+    probed_plugin)
+    """
+    if debug:
+        print('Loading plugins')
+    plugins_loaded = [{"filename": "plugin_settings.py",
+                       "plugin": extension()}]
+    if debug:
+        plugins_loaded[0]['plugin'].debug = True
+
+    for plugin in plugins.__all__:
+        if plugin not in ['__init__', 'plugin_settings.py']:
+            if host is not None:
+                ok, probed = host.call(probe_plugin, plugin)
+                if ok == False:
+                    quarantine_plugin(plugin, probed, debug)
+                    continue
+                plugins_loaded.append({"filename": plugin + ".py",
+                                       "plugin": probed_plugin(plugin, probed['title'], probed['is_submenu'], debug)})
+                continue
+            loaded = load_plugin(plugin, debug)
+            if loaded is not None:
+                plugins_loaded.append({"filename": plugin + ".py", "plugin": loaded})
+    return plugins_loaded
+
+
+class ignore_rules(object):
+    """ A set of gitignore style patterns compiled into one regular expression
+
+    Paths are matched relative to base, the folder the patterns belong to.
+    As in a .gitignore file a pattern without a slash (other than a trailing
+    one) matches a name at any depth, a trailing slash restricts it to
+    folders, '**' spans folders and a leading '!' re-includes what an
+    earlier pattern excluded. The last matching pattern wins, so the
+    alternatives are compiled in reverse order and the first to match
+    decides.
+    """
+
+    def __init__(self, patterns, base):
+        self.base = base.rstrip('/')
+        rules = []
+        for line in patterns:
+            line = line.rstrip()
+            if line == '' or line[0] == '#':
+                continue
+            negate = line[0] == '!'
+            if negate or line[0] == '\\':
+                line = line[1:]
+            folders_only = line.endswith('/')
+            line = line.rstrip('/')
+            if line == '':
+                continue
+            anchored = line.find('/') != -1
+            regex = self.translate(line.lstrip('/'))
+            if anchored == False:
+                regex = '(?:.*/)?' + regex
+            rules.append((regex + ('/' if folders_only else '/?'), negate))
+
+        rules.reverse()
+        self.negated = [negate for regex, negate in rules]
+        self.pattern = None
+        self.patterns = None
+        if len(rules) == 0:
+            return
+        try:
+            self.pattern = re.compile('(?:' + '|'.join(['(' + regex + ')' for regex, negate in rules]) + r')\Z', re.DOTALL)
+        except (AssertionError, OverflowError, re.error):
+            # Older versions of Python limit the number of groups
+            self.patterns = [re.compile(regex + r'\Z', re.DOTALL) for regex, negate in rules]
+
+
+    @classmethod
+    def from_file(cls, path, base):
+        try:
+            with codecs.open(path, 'r', encoding=system_encoding, errors='replace') as f:
+                return cls(f.read().split('\n'), base)
+        except (IOError, OSError):
+            return cls([], base)
+
+
+    def translate(self, pattern):
+        """ Returns the regular expression for a single pattern """
+        out = ''
+        i = 0
+        while i < len(pattern):
+            character = pattern[i]
+            if pattern[i:i + 3] == '**/':
+                out += '(?:.*/)?'
+                i += 3
+                continue
+            elif pattern[i:i + 3] == '/**' and i + 3 == len(pattern):
+                out += '/.+'
+                i += 3
+                continue
+            elif pattern[i:i + 2] == '**':
+                out += '.*'
+                i += 2
+                continue
+            elif character == '*':
+                out += '[^/]*'
+            elif character == '?':
+                out += '[^/]'
+            elif character == '[' and pattern.find(']', i + 2) != -1:
+                end = pattern.find(']', i + 2)
+                body = pattern[i + 1:end].replace('\\', '\\\\')
+                if body[0] == '!':
+                    body = '^' + body[1:]
+                out += '[' + body + ']'
+                i = end + 1
+                continue
+            elif character == '\\' and i + 1 < len(pattern):
+                out += re.escape(pattern[i + 1])
+                i += 2
+                continue
+            else:
+                out += re.escape(character)
+            i += 1
+        return out
+
+
+    def __len__(self):
+        return len(self.negated)
+
+
+    def match(self, path, is_folder):
+        """ Returns True if path is ignored, False if it is re-included by a
+        negated pattern and None if no pattern matches it.
+        """
+        path = path[len(self.base) + 1:]
+        if is_folder:
+            path += '/'
+        if self.pattern is not None:
+            match = self.pattern.match(path)
+            if match is None:
+                return None
+            return self.negated[match.lastindex - 1] == False
+        if self.patterns is not None:
+            for negated, pattern in zip(self.negated, self.patterns):
+                if pattern.match(path):
+                    return negated == False
+        return None
+
+
+def process_started():
+    """ Returns when the running process was started, to within a clock
+    tick, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - (uptime - ticks / float(os.sysconf('SC_CLK_TCK')))
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class launch_trace(object):
+    """ Timestamps the phases of a launch, from the process starting (or the
+    key press, for the launcher server) to the command being run.
+
+    Each call to mark() ends a phase, which is credited with the time since
+    the previous mark; a phase passed through more than once adds up. The
+    sample is appended to the trace log by save(), which keeps the last
+    samples launches.
+    """
+
+    def __init__(self, started=None, samples=1000):
+        self.samples = samples
+        self.phases = []
+        self.timings = {}
+        self.saved = False
+        # Without a key press time, startup runs from the process starting to
+        # this module being loaded; otherwise up to now
+        loaded = None
+        if started is None:
+            started = process_started()
+            loaded = time_loaded
+        if started is None:
+            self.started = time_loaded
+            self.last = time_loaded
+        else:
+            self.started = started
+            self.last = started
+            self.mark('startup', loaded)
+
+
+    def mark(self, phase, now=None):
+        if now is None:
+            now = time.time()
+        if phase not in self.timings:
+            self.phases.append(phase)
+            self.timings[phase] = 0
+        self.timings[phase] += now - self.last
+        self.last = now
+
+
+    def has(self, phase):
+        return phase in self.timings
+
+
+    def save(self, path=None):
+        if self.saved:
+            return
+        self.saved = True
+        path = path or file_cache_trace
+        sample = {'started': self.started,
+                  'phases': [[phase, round(self.timings[phase], 6)] for phase in self.phases]}
+        with codecs.open(path, 'a', encoding=system_encoding) as f:
+            f.write(json.dumps(sample) + '\n')
+            size = f.tell()
+        # Trim the log once it has grown well past the samples to keep
+        if size > self.samples * 512:
+            with codecs.open(path, 'r', encoding=system_encoding) as f:
+                lines = f.read().split('\n')[:-1]
+            with codecs.open(path + '.tmp', 'w', encoding=system_encoding) as f:
+                f.write('\n'.join(lines[-self.samples:]) + '\n')
+            os.rename(path + '.tmp', path)
+
+
+def trace_report(path=None):
+    """ Returns the p50 and p95 of every phase in the trace log as lines of
+    text.
+    """
+    path = path or file_cache_trace
+    timings = {}
+    order = []
+    count = 0
+    try:
+        with codecs.open(path, 'r', encoding=system_encoding) as f:
+            for line in f:
+                try:
+                    sample = json.loads(line)
+                except ValueError:
+                    continue
+                count += 1
+                for phase, seconds in sample['phases']:
+                    if phase not in timings:
+                        order.append(phase)
+                        timings[phase] = []
+                    timings[phase].append(seconds)
+    except (IOError, OSError):
+        pass
+    if count == 0:
+        return ['No launches have been traced, enable "trace_launches" in the preferences']
+
+    def percentile(values, fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    width = max([len(phase) for phase in order])
+    out = [str(count) + ' launches traced', 'phase'.ljust(width) + '   count     p50 ms     p95 ms']
+    for phase in order:
+        values = sorted(timings[phase])
+        out.append(phase.ljust(width) + str(len(values)).rjust(8) +
+                   ('%.1f' % (percentile(values, 0.5) * 1000)).rjust(11) +
+                   ('%.1f' % (percentile(values, 0.95) * 1000)).rjust(11))
+    return out
+
+
+class build_stats(object):
+    """ Timings and counters gathered while the cache is built
+
+    Each stage is timed between start() and stop(), adding up when a stage
+    runs more than once. The watch folders are described in roots. The
+    statistics are written as json by save() and summarised by report().
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.stages = []
+        self.timings = {}
+        self.running = {}
+        self.counters = {}
+        self.roots = {}
+
+
+    def start(self, stage):
+        self.running[stage] = time.time()
+
+
+    def stop(self, stage):
+        seconds = time.time() - self.running.pop(stage)
+        if stage not in self.timings:
+            self.stages.append(stage)
+            self.timings[stage] = 0
+        self.timings[stage] += seconds
+
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def as_dict(self):
+        finished = self.finished or time.time()
+        return {
+            'started': self.started,
+            'seconds': round(finished - self.started, 6),
+            'stages': [[stage, round(self.timings[stage], 6)] for stage in self.stages],
+            'counters': self.counters,
+            'roots': self.roots
+        }
+
+
+    def save(self, path):
+        self.finished = time.time()
+        with codecs.open(path + '.tmp', 'w', encoding=system_encoding) as f:
+            json.dump(self.as_dict(), f, sort_keys=True, indent=4)
+        os.rename(path + '.tmp', path)
+
+
+    def report(self):
+        """ Returns the statistics as lines of text """
+        stats = self.as_dict()
+        out = ['Cache built in ' + str(round(stats['seconds'], 3)) + 's (' +
+               str(self.counters.get('items', 0)) + ' items, ' +
+               str(self.counters.get('bytes written', 0)) + ' bytes written)']
+        width = max([len(stage) for stage in self.stages] + [0])
+        for stage, seconds in stats['stages']:
+            out.append('  ' + stage.ljust(width) + '  ' + str(round(seconds, 3)) + 's')
+        for name, value in sorted(self.counters.items()):
+            if name not in ['items', 'bytes written']:
+                out.append('  ' + name + ': ' + str(value))
+        for root, entry in sorted(self.roots.items()):
+            line = ('  ' + root + ': ' + str(entry['files']) + ' files, ' + str(entry['folders']) +
+                    ' folders, ' + str(entry['listed']) + ' listed in ' + str(round(entry['seconds'], 3)) + 's')
+            if entry.get('limited'):
+                line += ' (stopped on reaching its ' + entry['limited'] + ')'
+            out.append(line)
+        return out
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+    # A process which died but was not reaped yet is a zombie
+    try:
+        with open('/proc/' + str(pid) + '/stat', 'r') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, OSError, IndexError):
+        return True
+
+
+class rebuild_status(object):
+    """ The progress of a background rebuild, written to the status file
+    (at most every interval seconds unless forced) for rebuild_report
+    """
+
+    interval = 0.5
+
+    def __init__(self, path=None):
+        self.path = path or file_cache_status
+        self.state = {}
+        self.written = 0
+
+
+    def update(self, force=False, **values):
+        self.state.update(values)
+        if force or time.time() - self.written >= self.interval:
+            self.state['updated'] = time.time()
+            with codecs.open(self.path + '.tmp', 'w', encoding=system_encoding) as f:
+                json.dump(self.state, f)
+            os.rename(self.path + '.tmp', self.path)
+            self.written = time.time()
+
+
+def rebuild_state(path=None):
+    """ Returns the state last written by a background rebuild, or None
+
+    A rebuild said to be running whose process has gone is reported as
+    having failed.
+    """
+    try:
+        with codecs.open(path or file_cache_status, 'r', encoding=system_encoding) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if state.get('state') == 'running' and process_alive(state['pid']) == False:
+        state['state'] = 'failed'
+        state['error'] = 'the rebuild stopped unexpectedly'
+    return state
+
+
+def duration_text(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return str(seconds) + 's'
+    elif seconds < 3600:
+        return str(seconds // 60) + 'm ' + str(seconds % 60).zfill(2) + 's'
+    return str(seconds // 3600) + 'h ' + str(seconds % 3600 // 60).zfill(2) + 'm'
+
+
+def rebuild_eta(state, now=None):
+    """ Returns the estimated seconds left of a running rebuild, or None
+
+    While the watch folders are walked the estimate extrapolates from the
+    share of the folders of the previous build walked so far, otherwise
+    the previous build is assumed to take as long again.
+    """
+    elapsed = (now or time.time()) - state['started']
+    expected = state.get('expected_folders')
+    if state.get('stage') == 'walk' and expected and state.get('folders'):
+        share = min(float(state['folders']) / expected, 0.99)
+        return elapsed / share - elapsed
+    if state.get('expected_seconds'):
+        return max(state['expected_seconds'] - elapsed, 0)
+    return None
+
+
+def rebuild_report(state):
+    """ Returns lines describing the state of a background rebuild """
+    now = time.time()
+    if state['state'] == 'running':
+        out = ['Rebuilding the cache, ' + duration_text(now - state['started']) + ' so far']
+        if state.get('stage') == 'walk':
+            out.append('Scanning ' + str(state.get('root')))
+        elif state.get('stage') == 'write':
+            out.append('Writing the cache')
+        else:
+            out.append('Scanning applications and binaries')
+        out.append(str(state.get('files', 0)) + ' files found in ' + str(state.get('folders', 0)) + ' folders')
+        eta = rebuild_eta(state, now)
+        if eta is not None:
+            out.append('About ' + duration_text(eta) + ' left')
+        return out
+    elif state['state'] == 'done':
+        return ['The cache was rebuilt ' + duration_text(now - state['finished']) + ' ago'] + state.get('summary', [])
+    return ['The last rebuild failed: ' + state.get('error', 'unknown error')]
+
+
+class folder_scanner(object):
+    """ Walks the watch folders using a pool of worker threads
+
+    The tree is scanned one level at a time; the directories of the current
+    level are listed by the pool in parallel, a batch at a time, and the
+    filters (ignored folders and patterns, hidden items, valid extensions
+    and symlink handling) are applied to the results before the next level
+    is queued.
+
+    Each queued folder carries the ignore_rules that apply to it: the
+    ignore_patterns of its watch folder followed by those of any .gitignore
+    or .ignore files met on the way down, the deepest taking precedence.
+
+    When a manifest from a previous scan is loaded, folders whose mtime has
+    not changed are not listed again; their stored entries are reused. The
+    manifest of the scan is only gathered (in new_manifest) once one has
+    been loaded. Both are held in memory, an entry for every folder.
+
+    A watch folder may be given as a dictionary holding its 'path' and any
+    of 'max_depth' (levels of folders entered below it), 'valid_extensions'
+    (replacing the global list), 'max_entries' (files and folders indexed)
+    and 'time_budget' (seconds of scanning). A watch folder that reaches its
+    max_entries or time_budget stops being scanned and is noted in limited.
+    """
+
+    no_limits = (None, None, None, None)
+
+    def __init__(self, prefs, debug=False):
+        self.debug = debug
+        self.manifest = {}
+        self.new_manifest = None
+        self.listed = 0
+        self.reused = 0
+        self.started = time.time()
+        self.workers = max(1, int(prefs.get('scan_workers', 1)))
+        self.follow_symlinks = prefs.get('follow_symlinks', False)
+        self.scan_hidden_folders = prefs['scan_hidden_folders']
+        self.include_hidden_files = prefs['include_hidden_files']
+        self.include_hidden_folders = prefs['include_hidden_folders']
+
+        self.valid_extensions = self.extension_set(prefs.get('valid_extensions', []))
+
+        # Ignored folders are matched as whole paths, so they are held
+        # without a trailing separator
+        self.ignore_folders = set()
+        for exclude_folder in prefs.get('ignore_folders', []):
+            exclude_folder = exclude_folder.replace('~', os.path.expanduser('~'))
+            self.ignore_folders.add(exclude_folder.rstrip('/') or '/')
+
+        # Per watch folder (max_depth, extensions, max_entries, time_budget)
+        self.watch_folders = []
+        self.limits = {}
+        self.limited = {}
+        self.entries = {}
+        self.root_stats = {}
+        self.progress = None
+        # Called with each folder just before it is listed
+        self.entering = None
+        for folder in prefs.get('watch_folders', []):
+            settings = {}
+            if type(folder) == dict:
+                settings = folder
+                folder = settings.get('path', '')
+            folder = folder.replace('~', os.path.expanduser('~')).rstrip('/') or '/'
+            self.watch_folders.append(folder)
+            extensions = None
+            if 'valid_extensions' in settings:
+                extensions = self.extension_set(settings['valid_extensions'])
+            limits = (settings.get('max_depth'), extensions,
+                      settings.get('max_entries'), settings.get('time_budget'))
+            if limits != self.no_limits:
+                self.limits[folder] = limits
+        self.ignore_patterns = prefs.get('ignore_patterns', [])
+        self.ignore_files = []
+        if prefs.get('use_ignore_files', False):
+            self.ignore_files = ['.gitignore', '.ignore']
+
+
+    def list_directory(self, path):
+        """ Returns a (files, folders) tuple of the names found in path
+
+        Folders are given as (name, is_link) pairs. Anything that is not a
+        directory (or a link to one) is reported as a file, as os.walk does.
+        A directory that can not be read is treated as being empty.
+        """
+        files = []
+        folders = []
+        try:
+            if scandir is not None:
+                for entry in scandir(path):
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        folders.append((entry.name, entry.is_symlink()))
+                    else:
+                        files.append(entry.name)
+            else:
+                for name in os.listdir(path):
+                    pathname = os.path.join(path, name)
+                    if os.path.isdir(pathname):
+                        folders.append((name, os.path.islink(pathname)))
+                    else:
+                        files.append(name)
+        except OSError:
+            if self.debug:
+                print('Could not list ' + path)
+        files.sort()
+        folders.sort()
+        return files, folders
+
+
+    def list_directory_cached(self, path):
+        """ Returns the listing of path, reusing the manifest entry when the
+        folder's mtime matches the one recorded by the previous scan.
+
+        Manifest entries are [mtime, files, folders] with the names joined by
+        '/' (which can not appear in a name) and each folder name prefixed by
+        'l' for a link or 'd' otherwise.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return [], []
+
+        # Entries move to the new manifest, so the two are not both held
+        entry = self.manifest.pop(path, None)
+        if entry is not None and entry[0] == mtime:
+            self.reused += 1
+            files = entry[1].split('/') if entry[1] != '' else []
+            folders = [(x[1:], x[0] == 'l') for x in entry[2].split('/')] if entry[2] != '' else []
+        else:
+            files, folders = self.list_directory(path)
+            # A folder modified during the last second may change again
+            # without its mtime moving, so it is listed again next time
+            if mtime >= self.started - 1:
+                mtime = None
+            if self.new_manifest is None:
+                return files, folders
+            entry = [mtime,
+                     '/'.join(files),
+                     '/'.join([('l' if is_link else 'd') + name for name, is_link in folders])]
+        if self.new_manifest is not None:
+            self.new_manifest[path] = entry
+        return files, folders
+
+
+    def list_directory_timed(self, path):
+        started = time.time()
+        files, folders = self.list_directory_cached(path)
+        return files, folders, time.time() - started
+
+
+    def load_manifest(self, path):
+        self.new_manifest = {}
+        try:
+            with codecs.open(path, 'r', encoding=system_encoding) as f:
+                self.manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            if self.debug:
+                print('No usable manifest at ' + path + ', every folder will be listed')
+            self.manifest = {}
+
+
+    def save_manifest(self, path):
+        with codecs.open(path, 'w', encoding=system_encoding) as f:
+            json.dump(self.new_manifest, f)
+
+
+    def extension_set(self, extensions):
+        """ Returns the set of dotted, lower case extensions, or True when
+        any extension is valid.
+        """
+        out = set()
+        for extension in extensions:
+            if extension == '*':
+                return True
+            elif extension != '' and extension[0] != '.':
+                extension = '.' + extension
+            out.add(extension.lower())
+        return out
+
+
+    def valid_file(self, name, extensions=None):
+        if self.include_hidden_files == False and name.startswith('.'):
+            return False
+        if extensions is None:
+            extensions = self.valid_extensions
+        if extensions == True:
+            return True
+        # Equivalent to os.path.splitext(name)[1] without the call overhead
+        dot = name.rfind('.')
+        if dot <= 0 or (name[0] == '.' and name[:dot].strip('.') == ''):
+            return '' in extensions
+        return name[dot:].lower() in extensions
+
+
+    def root_for(self, path):
+        """ Returns (watch folder, depth) for the innermost watch folder
+        holding path, or (path, 0) if there is none.
+        """
+        path = path.rstrip('/') or '/'
+        root = None
+        for folder in self.watch_folders:
+            if path == folder or path.startswith(folder.rstrip('/') + '/'):
+                if root is None or len(folder) > len(root):
+                    root = folder
+        if root is None or root == path:
+            return path, 0
+        return root, path[len(root):].strip('/').count('/') + 1
+
+
+    def is_ignored(self, path):
+        """ Returns True if path is an ignored folder or lies beneath one """
+        path = path.rstrip('/')
+        while path != '':
+            if path in self.ignore_folders:
+                return True
+            path = path[:path.rfind('/')]
+        return '/' in self.ignore_folders
+
+
+    def read_ignore_files(self, path, rules, names=None):
+        """ Returns rules extended by the ignore files found in the folder
+        path. The names of the folder's files may be given to save looking.
+        """
+        for name in self.ignore_files:
+            if (name in names) if names is not None else os.path.isfile(os.path.join(path, name)):
+                found = ignore_rules.from_file(os.path.join(path, name), path)
+                if len(found) > 0:
+                    rules = rules + (found,)
+        return rules
+
+
+    def rules_for(self, path):
+        """ Returns the ignore_rules applying to the contents of the parents
+        of path, down from the innermost watch folder holding it (as for
+        root_for).
+        """
+        path = path.rstrip('/') or '/'
+        root = self.root_for(path)[0]
+        rules = ()
+        if len(self.ignore_patterns) > 0:
+            rules = (ignore_rules(self.ignore_patterns, root),)
+        if len(self.ignore_files) > 0 and path != root:
+            parts = path[len(root):].strip('/').split('/')
+            folder = root
+            for part in parts[:-1]:
+                rules = self.read_ignore_files(folder, rules)
+                folder = os.path.join(folder, part)
+            rules = self.read_ignore_files(folder, rules)
+        return rules
+
+
+    def is_excluded(self, rules, path, is_folder):
+        """ Returns True if the deepest ignore_rules with an opinion on path
+        ignore it.
+        """
+        for found in reversed(rules):
+            ignored = found.match(path, is_folder)
+            if ignored is not None:
+                return ignored
+        return False
+
+
+    def is_loop(self, root, path):
+        """ Returns True if the linked folder at path points back to one of
+        its own parents, in which case following it would never terminate.
+        """
+        target = os.path.realpath(path)
+        parent = os.path.realpath(root)
+        return parent == target or parent.startswith(target.rstrip('/') + '/')
+
+
+    def scan_batch(self, batch, listings, entries, filenames, foldernames, frontier):
+        """ Applies the filters and limits to the listings of a batch of
+        folders, adding the items found and queueing the folders to enter.
+        """
+        for (folder, rules, root, depth), listing in zip(batch, listings):
+            if root in self.limited:
+                continue
+            max_depth, extensions, max_entries, budget = self.limits.get(root, self.no_limits)
+            files, folders, seconds = listing
+            if len(self.ignore_files) > 0:
+                rules = self.read_ignore_files(folder, rules, files)
+            prefix = os.path.join(folder, '')
+            if len(rules) > 0:
+                new_files = [prefix + name for name in files if self.valid_file(name, extensions)
+                             and self.is_excluded(rules, prefix + name, False) == False]
+            else:
+                new_files = [prefix + name for name in files if self.valid_file(name, extensions)]
+            new_folders = []
+            children = []
+            for name, is_link in folders:
+                path = os.path.join(folder, name)
+                if path in self.ignore_folders:
+                    continue
+                if len(rules) > 0 and self.is_excluded(rules, path, True):
+                    continue
+                if self.include_hidden_folders or name.startswith('.') == False:
+                    new_folders.append(path + '/')
+                if self.scan_hidden_folders == False and name.startswith('.'):
+                    continue
+                if is_link and (self.follow_symlinks == False or self.is_loop(folder, path)):
+                    continue
+                if path in self.watch_folders:
+                    # A nested watch folder anchors the patterns and limits
+                    # of what lies beneath it, as root_for has it
+                    children.append((path, self.rules_for(path), path, 0))
+                elif max_depth is None or depth < max_depth:
+                    children.append((path, rules, root, depth + 1))
+
+            if max_entries is not None:
+                room = max_entries - entries.get(root, 0)
+                if len(new_files) + len(new_folders) > room:
+                    new_files = new_files[:room]
+                    new_folders = new_folders[:room - len(new_files)]
+                    children = []
+                    self.limited[root] = 'max_entries'
+                entries[root] = entries.get(root, 0) + len(new_files) + len(new_folders)
+
+            filenames.extend(new_files)
+            foldernames.extend(new_folders)
+            frontier.extend(children)
+
+            if root not in self.root_stats:
+                self.root_stats[root] = {'files': 0, 'folders': 0, 'listed': 0, 'seconds': 0}
+            stats = self.root_stats[root]
+            stats['files'] += len(new_files)
+            stats['folders'] += len(new_folders)
+            stats['listed'] += 1
+            stats['seconds'] += seconds
+
+
+    def scan(self, watch_folders, filenames=None, foldernames=None, entries=None):
+        """ Returns (filenames, foldernames) found beneath the watch folders,
+        extending the given lists (or anything with extend and len) if any
+
+        The items counted towards each watch folder's max_entries are kept
+        in entries, which may hold the counts of an earlier scan to carry
+        on from.
+        """
+        if filenames is None:
+            filenames = []
+        if foldernames is None:
+            foldernames = []
+        if entries is None:
+            entries = {}
+        self.entries = entries
+        self.limited = {}
+
+        # Nothing beneath a hidden folder is ever indexed unless hidden
+        # folders are to be scanned, so such trees are not entered at all.
+        # Ignored folders are pruned as they are met, so only the watch
+        # folders themselves need checking against their parents.
+        frontier = []
+        for folder in watch_folders:
+            if (self.scan_hidden_folders or folder.find('/.') == -1) and self.is_ignored(folder) == False:
+                root, depth = self.root_for(folder)
+                frontier.append((folder, self.rules_for(folder), root, depth))
+
+        started = time.time()
+        batch_size = self.workers * 16
+        scanned = 0
+        time_budgets = dict([(root, limits[3]) for root, limits in self.limits.items() if limits[3] is not None])
+
+        if self.workers > 1:
+            pool = ThreadPool(self.workers)
+            list_all = pool.map
+        else:
+            pool = None
+            list_all = lambda func, items: list(map(func, items))
+
+        try:
+            while len(frontier) > 0:
+                next_frontier = []
+                # Time budgets are checked between batches of folders,
+                # otherwise larger ones are listed, never a whole level at
+                # once so that only a batch of listings is held at a time
+                if len(time_budgets) > 0:
+                    size = batch_size
+                else:
+                    size = batch_size * 16
+                for first in range(0, len(frontier), size):
+                    batch = frontier[first:first + size]
+                    if len(time_budgets) > 0:
+                        elapsed = time.time() - started
+                        for item in batch:
+                            root = item[2]
+                            if root in time_budgets and elapsed >= time_budgets[root] and root not in self.limited:
+                                self.limited[root] = 'time_budget'
+                    batch = [item for item in batch if item[2] not in self.limited]
+                    if self.entering is not None:
+                        for item in batch:
+                            self.entering(item[0])
+                    listings = list_all(self.list_directory_timed, [item[0] for item in batch])
+                    self.scan_batch(batch, listings, entries, filenames, foldernames, next_frontier)
+                    scanned += len(batch)
+                    self.listed += len(batch)
+                    if self.progress is not None and len(batch) > 0:
+                        self.progress(batch[-1][2], scanned, len(filenames))
+                frontier = next_frontier
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if self.debug:
+            for root, reason in sorted(self.limited.items()):
+                print('Stopped scanning ' + root + ' on reaching its ' + reason)
+
+        return filenames, foldernames
+
+
+class alias_store(object):
+    """ Keyed lookup from the title of an aliased item to its command
+
+    The aliases are held in a small sqlite database, so looking up, adding or
+    removing an alias touches a single row however many aliases there are.
+    A complete set of aliases is written to a temporary database which then
+    replaces the store, so a reader never sees a partial store.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or file_cache_aliases_store
+        self.connection = None
+
+    def connect(self, path):
+        connection = sqlite3.connect(path, timeout=5)
+        connection.execute('CREATE TABLE IF NOT EXISTS aliases '
+                           '(title TEXT PRIMARY KEY, command TEXT NOT NULL)')
+        return connection
+
+    def open(self):
+        if self.connection is None:
+            # Carry over the aliases of the older json lookup file
+            if os.path.exists(self.path) == False and os.path.exists(file_cache_aliasesLookup):
+                try:
+                    with codecs.open(file_cache_aliasesLookup, 'r', encoding=system_encoding) as f:
+                        self.replace(json.load(f))
+                except (IOError, OSError, ValueError):
+                    pass
+            self.connection = self.connect(self.path)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get(self, title):
+        row = self.open().execute('SELECT command FROM aliases WHERE title = ?',
+                                  (title,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set(self, title, command):
+        connection = self.open()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO aliases VALUES (?, ?)',
+                               (title, command))
+
+    def remove(self, title):
+        connection = self.open()
+        with connection:
+            connection.execute('DELETE FROM aliases WHERE title = ?', (title,))
+
+    def replace(self, aliases):
+        """ Replaces the whole store with the given [title, command] pairs """
+        fd, path = tempfile.mkstemp(prefix='.dmenuExtended_aliases', dir=os.path.dirname(self.path))
+        os.close(fd)
+        try:
+            connection = self.connect(path)
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO aliases VALUES (?, ?)',
+                                       [(title, command) for title, command in aliases])
+            connection.close()
+            os.rename(path, self.path)
+        except:
+            os.remove(path)
+            raise
+        self.close()
+
+
+class http_pool(object):
+    """ Keeps HTTP(S) connections open to be reused between requests
+
+    A connection serves one request at a time, so each request takes an
+    idle connection to its host (or opens a new one) and hands it back
+    once the response has been read. The idle connections are shared by
+    all threads: concurrent requests open as many connections as there are
+    requests in flight, and later requests from any thread reuse them.
+    """
+
+    redirects = 5
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+
+    def connection(self, scheme, host, fresh=False):
+        """ Returns an idle connection to host, or a new one """
+        if fresh == False:
+            with self.lock:
+                idle = self.idle.get((scheme, host))
+                if idle:
+                    return idle.pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        elif scheme == 'http':
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+        raise ValueError('Unsupported url: ' + scheme + '://' + host)
+
+
+    def release(self, scheme, host, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(connection)
+
+
+    def request(self, url, headers=None, redirects=None):
+        """ Returns the status, headers (with lower case names) and body of
+        a GET request for url, following redirects
+        """
+        if redirects is None:
+            redirects = self.redirects
+        parts = urlparse(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        for attempt in range(2):
+            connection = self.connection(parts.scheme, parts.netloc, attempt == 1)
+            try:
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except socket.timeout:
+                connection.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed a connection kept open, so
+                # try once more on a new one
+                connection.close()
+                if attempt == 1:
+                    raise
+
+        response_headers = dict([(name.lower(), value) for name, value in response.getheaders()])
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(parts.scheme, parts.netloc, connection)
+        if response.status in [301, 302, 303, 307, 308] and 'location' in response_headers and redirects > 0:
+            return self.request(urljoin(url, response_headers['location']), headers, redirects - 1)
+        if response.status >= 400:
+            raise IOError('HTTP error ' + str(response.status) + ' fetching ' + url)
+        return response.status, response_headers, body
+
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class http_cache(object):
+    """ Keeps the responses to GET requests made through an http_pool on
+    disk, revalidating them with their ETag and Last-Modified headers
+
+    Each response is stored in a file of its own beneath path, named by the
+    sha1 of its url, holding a line of json (the url, validators and time
+    fetched) followed by the body. Cached bodies are used when the server
+    cannot be reached, so what was downloaded once stays available offline.
+    """
+
+    def __init__(self, pool, path=path_cache_http, debug=False):
+        self.pool = pool
+        self.path = path
+        self.debug = debug
+
+
+    def entry_path(self, url):
+        return self.path + '/' + hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+    def load(self, url):
+        """ Returns the (metadata, body) cached for url, or None """
+        try:
+            with open(self.entry_path(url), 'rb') as f:
+                data = f.read()
+            header, body = data.split(b'\n', 1)
+            meta = json.loads(header.decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('url') != url:
+            return None
+        return meta, body
+
+
+    def save(self, url, meta, body):
+        if os.path.exists(self.path) == False:
+            os.makedirs(self.path)
+        meta['url'] = url
+        handle, path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(json.dumps(meta).encode('utf-8') + b'\n')
+                f.write(body)
+            os.rename(path, self.entry_path(url))
+        except:
+            os.remove(path)
+            raise
+
+
+    def revalidate(self, url, cached=None):
+        """ Returns the body of url, asking the server for it only if it
+        changed since it was cached
+        """
+        headers = {}
+        if cached is not None:
+            if cached[0].get('etag'):
+                headers['If-None-Match'] = cached[0]['etag']
+            if cached[0].get('last_modified'):
+                headers['If-Modified-Since'] = cached[0]['last_modified']
+        status, response_headers, body = self.pool.request(url, headers)
+        if status == 304 and cached is not None:
+            if self.debug:
+                print('Not modified: ' + url)
+            meta, body = cached
+        else:
+            meta = {'etag': response_headers.get('etag'),
+                    'last_modified': response_headers.get('last-modified')}
+        meta['fetched'] = time.time()
+        self.save(url, meta, body)
+        return body
+
+
+    def revalidate_quietly(self, url, cached):
+        try:
+            self.revalidate(url, cached)
+        except Exception as e:
+            if self.debug:
+                print('Could not revalidate ' + url + ': ' + str(e))
+
+
+    def revalidate_detached(self, url, cached):
+        """ Revalidates url in a detached process, which outlives the
+        (usually short lived) process asking for it
+        """
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if os.fork() == 0:
+                    # The connections of the pool are the parent's, so
+                    # fresh ones are made
+                    http_cache(http_pool(self.pool.timeout), self.path, self.debug).revalidate_quietly(url, cached)
+            finally:
+                os._exit(0)
+        try:
+            os.waitpid(pid, 0)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+
+
+    def get(self, url, max_age=0, stale=False, fallback=True):
+        """ Returns the body of url
+
+        Responses cached less than max_age seconds ago are used as they are.
+        Older ones are revalidated, unless stale is set, in which case the
+        cached body is returned at once and revalidated by a detached
+        process.
+        When the server cannot be reached, whatever was cached is returned,
+        unless fallback is False, in which case the error is raised.
+        """
+        cached = self.load(url)
+        if cached is not None:
+            age = time.time() - cached[0].get('fetched', 0)
+            if age < max_age:
+                return cached[1]
+            if stale:
+                self.revalidate_detached(url, cached)
+                return cached[1]
+        try:
+            return self.revalidate(url, cached)
+        except (IOError, OSError, httplib.HTTPException) as e:
+            if cached is None or fallback == False:
+                raise
+            if self.debug:
+                print('Using the cached copy of ' + url + ': ' + str(e))
+            return cached[1]
+
+
+def sha1_file(path):
+    """ Returns the hex sha1 digest of the file at path """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def array_from_bytes(typecode, data):
+    out = array(typecode)
+    if hasattr(out, 'frombytes'):
+        out.frombytes(data)
+    else:
+        out.fromstring(data)
+    return out
+
+
+def array_to_bytes(values):
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+def bitmap_to_int(data):
+    """ Returns the little-endian bitmap data as an integer """
+    if hasattr(int, 'from_bytes'):
+        return int.from_bytes(data, 'little')
+    if len(data) == 0:
+        return 0
+    return int(binascii.hexlify(bytes(bytearray(reversed(bytearray(data))))), 16)
+
+
+def int_to_bitmap(value, length):
+    """ Returns the integer value as a little-endian bitmap of length bytes """
+    if hasattr(value, 'to_bytes'):
+        return value.to_bytes(length, 'little')
+    if length == 0:
+        return b''
+    return bytes(bytearray(reversed(bytearray(binascii.unhexlify('%0*x' % (length * 2, value))))))
+
+
+class packed_cache(object):
+    """ Read-only, memory mapped view of the packed cache file
+
+    The packed cache holds the plugins followed by the rest of the cache in
+    the order they are shown in the menu:
+
+        header      magic, version, item count and the offsets of the
+                    sections below
+        data        every item as utf-8 text terminated by a newline
+        index       the offset of every item within data (plus the end of
+                    the data) as uint32, then one category byte per item
+        basenames   the offset of the basename within every item as uint32
+        lowercase   data with ascii letters in lower case (same offsets)
+        bitmaps     for each of indexed_characters, one bit per block of
+                    block_size consecutive items telling whether any item of
+                    the block contains that character
+
+    Items can be streamed to the menu and selected by category straight
+    from the mapped file, without decoding or splitting the whole cache. The
+    last three sections serve fuzzy_matcher.
+    """
+
+    magic = b'DMXCACHE'
+    version = 2
+    header = struct.Struct('<8sIIQQQQQQ')
+
+    # Item categories
+    PLUGIN = 0
+    ALIAS = 1
+    BINARY = 2
+    FOLDER = 3
+    FILE = 4
+    OTHER = 5
+
+    # Characters with a presence bitmap, and the number of items per bit
+    indexed_characters = b'abcdefghijklmnopqrstuvwxyz0123456789'
+    block_size = 64
+
+    # Type code of a 32 bit unsigned integer array
+    offset_type = 'I' if array('I').itemsize == 4 else 'L'
+
+    # Generation of the cache files the cache was opened at, when known
+    generation = None
+
+    promoted = []
+    promoted_spans = []
+    added = []
+    removed = frozenset()
+    removed_spans = []
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self.count, self.data_offset, self.data_length, self.index_offset,
+             self.basename_offset, self.lower_offset, self.bitmap_offset) = self.header.unpack_from(self.map, 0)
+            if magic != self.magic or version != self.version:
+                raise ValueError('Unsupported cache format in ' + path)
+            self.blocks = (self.count + self.block_size - 1) // self.block_size
+            self.bitmap_length = (self.blocks + 7) // 8
+            if self.bitmap_offset + self.bitmap_length * len(self.indexed_characters) > len(self.map):
+                raise ValueError('Truncated cache file ' + path)
+            end_offsets = self.index_offset + 4 * (self.count + 1)
+            self.offsets = array_from_bytes(self.offset_type, self.map[self.index_offset:end_offsets])
+            self.categories = self.map[end_offsets:end_offsets + self.count]
+        except:
+            self.map.close()
+            raise
+
+
+    def basenames(self):
+        return array_from_bytes(self.offset_type, self.map[self.basename_offset:self.basename_offset + 4 * self.count])
+
+
+    def bitmap(self, character):
+        """ Returns an integer with bit i set when an item of block i
+        contains the (indexed) lower case character.
+        """
+        start = self.bitmap_offset + self.bitmap_length * self.indexed_characters.index(character)
+        return bitmap_to_int(self.map[start:start + self.bitmap_length])
+
+
+    def __len__(self):
+        return self.count
+
+
+    def plugins(self):
+        """ Returns the number of plugins, which come before the rest """
+        return re.match(b'\x00*', self.categories).end()
+
+
+    def item_span(self, index):
+        """ Returns the (start, end) byte range of the item at index """
+        return self.data_offset + self.offsets[index], self.data_offset + self.offsets[index + 1]
+
+
+    def index(self, item):
+        """ Returns the index of item, or None if it is not in the cache """
+        span = self.find_item(item)
+        if span is None:
+            return None
+        return bisect.bisect_left(self.offsets, span[0] - self.data_offset)
+
+
+    def position(self, item):
+        """ Returns the index of item among the items following the
+        plugins, or None if it is not one of them.
+        """
+        index = self.index(item)
+        plugins = self.plugins()
+        return index - plugins if index is not None and index >= plugins else None
+
+
+    def locate(self, item, index=None):
+        """ Returns the byte range of item as find_item does, trying the
+        expected index first. An index of -1 means the item is known not to
+        be in the cache, while None means nothing is known.
+        """
+        if index is None:
+            return self.find_item(item)
+        if index < 0:
+            return None
+        if index < self.count:
+            span = self.item_span(index)
+            if self.map[span[0]:span[1]] == item.encode('utf-8') + b'\n':
+                return span
+        return self.find_item(item)
+
+
+    def find_item(self, item):
+        """ Returns the (start, end) byte range of item within the mapped
+        file (including its newline), or None if it is not in the cache.
+        """
+        data = item.encode('utf-8') + b'\n'
+        start = self.data_offset
+        if self.map[start:start + len(data)] != data:
+            start = self.map.find(b'\n' + data, start, self.data_offset + self.data_length)
+            if start == -1:
+                return None
+            start += 1
+        return start, start + len(data)
+
+
+    def overlay(self, added, removed, indexes=None):
+        """ Applies the store edits made since the cache was written: the
+        added (item, category) pairs are shown ahead of the cache and the
+        removed items are left out.
+
+        indexes maps items to where they were last found in the cache (see
+        locate), so that they need not be looked for.
+        """
+        if indexes is None:
+            indexes = {}
+        self.added = []
+        self.removed = frozenset(removed)
+        self.removed_spans = []
+        for item in self.removed:
+            span = self.locate(item, indexes.get(item))
+            if span is not None:
+                self.removed_spans.append(span)
+        self.removed_spans.sort()
+        for item, category in added:
+            if item not in self.removed and self.locate(item, indexes.get(item)) is None:
+                self.added.append((item, category))
+
+
+    def promote(self, items):
+        """ Moves the given items, where present, to the front of the items
+        produced by chunks(). Returns the items that were found.
+
+        The items are (item, position) pairs, position being the index of
+        the item among those following the plugins as recorded when the
+        cache was built. An item is only looked for in the cache when its
+        position is unknown (None); one no longer found at its position is
+        left where it is.
+        """
+        self.promoted = []
+        self.promoted_spans = []
+        plugins = None
+        for item, position in items:
+            if item in self.removed:
+                continue
+            if position is None:
+                span = self.find_item(item)
+            else:
+                if plugins is None:
+                    plugins = self.plugins()
+                span = None
+                if plugins + position < self.count:
+                    span = self.item_span(plugins + position)
+                    if self.map[span[0]:span[1]] != item.encode('utf-8') + b'\n':
+                        span = None
+            if span is not None:
+                self.promoted.append(item)
+                self.promoted_spans.append(span)
+        self.promoted_spans.sort()
+        return self.promoted
+
+
+    def close(self):
+        self.map.close()
+
+
+    def item(self, index):
+        start = self.data_offset + self.offsets[index]
+        end = self.data_offset + self.offsets[index + 1] - 1
+        return self.map[start:end].decode('utf-8')
+
+
+    def added_items(self, categories=None):
+        return [item for item, category in self.added if categories is None or category in categories]
+
+
+    def items(self, categories=None):
+        """ Yields the decoded items, optionally of the given categories
+        only, in the order of chunks()
+        """
+        head = self.added_items(categories)
+        spans = self.removed_spans
+        if categories is None and len(self.promoted) > 0:
+            head = self.promoted + head
+            spans = sorted(spans + self.promoted_spans)
+        for item in head:
+            yield item
+        for start, end in self.runs(categories, spans):
+            for item in self.map[start:end - 1].decode('utf-8').split('\n'):
+                yield item
+
+
+    def index_runs(self, categories=None):
+        """ Yields (first, last + 1) item indexes of consecutive items
+        belonging to the given categories (or of all items).
+        """
+        if categories is None:
+            if self.count > 0:
+                yield 0, self.count
+            return
+        wanted = b''.join([re.escape(struct.pack('B', x)) for x in categories])
+        for match in re.finditer(b'[' + wanted + b']+', self.categories):
+            yield match.start(), match.end()
+
+
+    def runs(self, categories=None, skip=()):
+        """ Yields (start, end) byte ranges of consecutive items belonging to
+        the given categories (or of all items), leaving out the sorted
+        (start, end) ranges of skip.
+        """
+        for first, last in self.index_runs(categories):
+            start = self.data_offset + self.offsets[first]
+            end = self.data_offset + self.offsets[last]
+            for skip_start, skip_end in skip:
+                if skip_end > start and skip_start < end:
+                    if skip_start > start:
+                        yield start, skip_start
+                    start = skip_end
+            if start < end:
+                yield start, end
+
+
+    def chunks(self, categories=None, size=65536):
+        """ Yields the newline separated items as utf-8 encoded chunks of at
+        most size bytes, read straight from the mapped file.
+
+        When all categories are requested any promoted items come first and
+        are skipped where they would otherwise appear. Added items follow
+        them and removed items are skipped.
+        """
+        head = self.added_items(categories)
+        spans = self.removed_spans
+        if categories is None and len(self.promoted) > 0:
+            head = self.promoted + head
+            spans = sorted(spans + self.promoted_spans)
+        if len(head) > 0:
+            yield ('\n'.join(head) + '\n').encode('utf-8')
+        for start, end in self.runs(categories, spans):
+            while start < end:
+                yield self.map[start:min(start + size, end)]
+                start += size
+
+
+    def data(self, categories=None):
+        """ Returns the newline separated items as utf-8 encoded bytes """
+        head = ''.join([item + '\n' for item in self.added_items(categories)]).encode('utf-8')
+        return head + b''.join([self.map[start:end] for start, end in self.runs(categories, self.removed_spans)])
+
+
+    def search(self, needle, categories=None):
+        """ Returns the items containing needle, optionally of the given
+        categories only. The data is searched in place using mmap.find.
+        """
+        out = [item for item in self.added_items(categories) if needle in item]
+        needle = needle.encode('utf-8')
+        for start, end in self.runs(categories, self.removed_spans):
+            position = self.map.find(needle, start, end)
+            while position != -1 and position < end:
+                item_start = self.map.rfind(b'\n', start, position) + 1
+                if item_start == 0:
+                    item_start = start
+                item_end = self.map.find(b'\n', position, end)
+                out.append(self.map[item_start:item_end].decode('utf-8'))
+                position = self.map.find(needle, item_end + 1, end)
+        return out
+
+
+class packed_cache_writer(object):
+    """ Writes a packed cache file (see packed_cache) one item at a time
+
+    The items are written to a temporary file as they are added (their
+    lower case copy to a second one) and the remaining sections are appended
+    when the writer is closed, at which point the file replaces the existing
+    cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.temp = path + '.tmp'
+        self.file = open(self.temp, 'wb')
+        self.file.write(b'\0' * packed_cache.header.size)
+        self.lower_file = tempfile.TemporaryFile(dir=os.path.dirname(path))
+        self.offsets = array(packed_cache.offset_type, [0])
+        self.basenames = array(packed_cache.offset_type)
+        self.categories = bytearray()
+        self.bitmaps = dict([(x, bytearray()) for x in bytearray(packed_cache.indexed_characters)])
+        self.block = []
+        self.length = 0
+
+
+    def add(self, item, category):
+        data = (item + '\n').encode('utf-8')
+        self.file.write(data)
+        self.length += len(data)
+        self.offsets.append(self.length)
+        self.basenames.append(data.rstrip(b'/\n').rfind(b'/') + 1)
+        self.categories.append(category)
+        self.block.append(data.lower())
+        if len(self.block) == packed_cache.block_size:
+            self.add_block()
+
+
+    def add_block(self):
+        """ Writes the lower case copy of the current block of items and
+        records the characters it contains.
+        """
+        lower = b''.join(self.block)
+        self.lower_file.write(lower)
+        index = (len(self.categories) - 1) // packed_cache.block_size
+        byte, bit = index >> 3, 1 << (index & 7)
+        for character, bitmap in self.bitmaps.items():
+            if len(bitmap) == byte:
+                bitmap.append(0)
+        for character in set(bytearray(lower)):
+            if character in self.bitmaps:
+                self.bitmaps[character][byte] |= bit
+        self.block = []
+
+
+    def extend(self, items, category):
+        for item in items:
+            self.add(item, category)
+
+
+    def close(self):
+        if len(self.block) > 0:
+            self.add_block()
+        count = len(self.categories)
+        data_offset = packed_cache.header.size
+        index_offset = data_offset + self.length
+        self.file.write(array_to_bytes(self.offsets))
+        self.file.write(bytes(self.categories))
+        basename_offset = self.file.tell()
+        self.file.write(array_to_bytes(self.basenames))
+        lower_offset = self.file.tell()
+        self.lower_file.seek(0)
+        shutil.copyfileobj(self.lower_file, self.file)
+        self.lower_file.close()
+        bitmap_offset = self.file.tell()
+        for character in bytearray(packed_cache.indexed_characters):
+            self.file.write(bytes(self.bitmaps[character]))
+        self.file.seek(0)
+        self.file.write(packed_cache.header.pack(packed_cache.magic, packed_cache.version, count,
+                                                 data_offset, self.length, index_offset,
+                                                 basename_offset, lower_offset, bitmap_offset))
+        self.file.close()
+        os.rename(self.temp, self.path)
+
+
+def cache_lock():
+    """ Returns the lock file of the cache folder, holding an exclusive
+    advisory lock on it until it is closed
+    """
+    lock = open(file_cache_lock, 'a')
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    return lock
+
+
+def cache_generation():
+    """ Returns (generation, committing) of the cache files on disk """
+    try:
+        with open(file_cache_generation, 'r') as f:
+            state = json.load(f)
+        return state['generation'], state['committing']
+    except (IOError, OSError, ValueError, KeyError):
+        return 0, False
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class cache_set(object):
+    """ Replaces a set of cache files together
+
+    Every file of the set is written to the temporary path handed out by
+    path and the cache is left untouched until commit, which syncs the new
+    files to disk and renames them all into place under the cache lock, so
+    two writers never interleave. The generation number is marked as
+    committing while the files are renamed, letting readers of several
+    cache files (see dmenu.cache_read) check they saw a single generation
+    without ever waiting on the lock.
+    """
+
+    def __init__(self):
+        self.temps = []
+        self.cuts = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+
+    def path(self, final):
+        """ Returns the temporary path to write final to """
+        temp = final + '.' + str(os.getpid()) + '.new'
+        self.temps.append((temp, final))
+        return temp
+
+
+    def cut(self, final, head):
+        """ Removes the lines read from the start of final as head along
+        with the commit, keeping any appended to it since
+        """
+        self.cuts.append((final, head))
+
+
+    def apply_cut(self, final, head):
+        try:
+            with open(final, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return
+        # Another commit may have cut the start of head already, leaving
+        # only its last lines at the start of final
+        start = 0
+        while data.startswith(head[start:]) == False:
+            start = head.index(b'\n', start) + 1
+        data = data[len(head) - start:]
+        if len(data) == 0:
+            os.remove(final)
+            return
+        temp = final + '.' + str(os.getpid()) + '.new'
+        with open(temp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, final)
+
+
+    def write_generation(self, generation, committing):
+        with open(file_cache_generation + '.tmp', 'w') as f:
+            json.dump({'generation': generation, 'committing': committing}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(file_cache_generation + '.tmp', file_cache_generation)
+
+
+    def commit(self):
+        """ Moves the files of the set into place, returning the generation
+        number they were given
+        """
+        temps = [(temp, final) for temp, final in self.temps if os.path.exists(temp)]
+        for temp, final in temps:
+            fsync_path(temp)
+        with cache_lock():
+            generation = cache_generation()[0] + 1
+            self.write_generation(generation, True)
+            for temp, final in temps:
+                os.rename(temp, final)
+            for final, head in self.cuts:
+                self.apply_cut(final, head)
+            fsync_path(path_cache)
+            self.write_generation(generation, False)
+            self.sweep()
+        self.temps = []
+        self.cuts = []
+        return generation
+
+
+    def sweep(self):
+        """ Removes the files left behind by writers which died before
+        committing
+        """
+        for name in os.listdir(path_cache):
+            match = re.search(r'\.(\d+)\.new', name)
+            if match is not None and process_alive(int(match.group(1))) == False:
+                os.remove(path_cache + '/' + name)
+
+
+    def abort(self):
+        for temp, final in self.temps:
+            if os.path.exists(temp):
+                os.remove(temp)
+        self.temps = []
+        self.cuts = []
+
+
+class spool_sorter(object):
+    """ Sorts items by length, then by the group they were added to, in
+    bounded memory
+
+    Items are held until run_size of them have been added, when they are
+    sorted and spooled to a temporary file as a run. items() merges the
+    runs. Whenever max_runs runs of the same size have been written they are
+    merged into one larger run, so that few files are open at a time and
+    each item is rewritten only a handful of times. Items of the same length and
+    group keep the order they were added in, as with a stable sort of the
+    whole.
+    """
+
+    max_runs = 64
+
+    def __init__(self, run_size=20000, directory=None):
+        self.run_size = max(1, run_size)
+        self.directory = directory
+        self.buffer = []
+        self.runs = []
+
+
+    def add(self, item, group=0):
+        self.buffer.append((len(item), group, item))
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+
+    def extend(self, items, group=0):
+        for item in items:
+            self.buffer.append((len(item), group, item))
+            if len(self.buffer) >= self.run_size:
+                self.spill()
+
+
+    def spill(self):
+        self.buffer.sort(key=lambda entry: (entry[0], entry[1]))
+        self.runs.append((0, self.write_run(self.buffer)))
+        self.buffer = []
+        # Runs are (level, file), a level n run being a merge of max_runs
+        # runs of level n - 1
+        while len(self.runs) >= self.max_runs:
+            level = self.runs[-1][0]
+            merged = self.runs[-self.max_runs:]
+            if any([x[0] != level for x in merged]):
+                break
+            self.runs = self.runs[:-self.max_runs]
+            self.runs.append((level + 1, self.write_run(self.merge([x[1] for x in merged]))))
+
+
+    def write_run(self, entries):
+        run = tempfile.TemporaryFile(dir=self.directory)
+        lines = []
+        for entry in entries:
+            lines.append(str(entry[1]) + ' ' + entry[-1])
+            if len(lines) == 4096:
+                run.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                lines = []
+        if len(lines) > 0:
+            run.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        run.seek(0)
+        return run
+
+
+    def read_run(self, number, run):
+        position = 0
+        for line in run:
+            group, item = line[:-1].decode('utf-8').split(' ', 1)
+            yield len(item), int(group), number, position, item
+            position += 1
+
+
+    def merge(self, runs):
+        """ Yields (length, group, run, position, item) for the items of
+        the runs in order, closing them once read
+        """
+        for entry in heapq.merge(*[self.read_run(number, run) for number, run in enumerate(runs)]):
+            yield entry
+        for run in runs:
+            run.close()
+
+
+    def items(self):
+        if len(self.runs) == 0:
+            self.buffer.sort(key=lambda entry: (entry[0], entry[1]))
+            for entry in self.buffer:
+                yield entry[2]
+            return
+        if len(self.buffer) > 0:
+            self.spill()
+        runs = [x[1] for x in self.runs]
+        self.runs = []
+        for entry in self.merge(runs):
+            yield entry[4]
+
+
+    def close(self):
+        for level, run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+
+
+class cache_sink(object):
+    """ Takes the items of one category for a cache_stream, as a list would """
+
+    def __init__(self, stream, f, group):
+        self.stream = stream
+        self.file = f
+        self.group = group
+        self.length = 0
+
+
+    def __len__(self):
+        return self.length
+
+
+    def append(self, item):
+        self.file.write(item + '\n')
+        self.stream.add(item, self.group)
+        self.length += 1
+
+
+    def extend(self, items):
+        items = list(items)
+        if len(items) > 0:
+            self.file.write('\n'.join(items) + '\n')
+        self.stream.extend(items, self.group)
+        self.length += len(items)
+
+
+class cache_stream(object):
+    """ Writes the cache files of a build as its items are produced
+
+    Each item is written to the text file of its category (see sink) as it
+    arrives, and passes on to a spool_sorter for the full cache unless it is
+    excluded. Items with a frecency score are set aside to be placed first.
+    At most run_size items are held in memory at a time.
+    """
+
+    INCLUDED, ALIASED, BINARY, FOLDER, FILE = range(5)
+
+    def __init__(self, pending, exclude=(), scores=None, run_size=20000):
+        self.pending = pending
+        self.exclude = set(exclude)
+        self.scores = scores or {}
+        self.sorter = spool_sorter(run_size, path_cache)
+        self.ranked = []
+        self.positions = {}
+        self.files = []
+        self.count = 0
+
+
+    def sink(self, path, group):
+        """ Returns a cache_sink for the items of group, which are written
+        to path as part of the cache_set pending
+        """
+        f = codecs.open(self.pending.path(path), 'w', encoding=system_encoding)
+        self.files.append(f)
+        return cache_sink(self, f, group)
+
+
+    def add(self, item, group):
+        if item in self.exclude:
+            return
+        self.count += 1
+        if item in self.scores:
+            self.ranked.append((group, item))
+        else:
+            self.sorter.add(item, group)
+
+
+    def extend(self, items, group):
+        if len(self.exclude) > 0 or len(self.scores) > 0:
+            for item in items:
+                self.add(item, group)
+        else:
+            self.count += len(items)
+            self.sorter.extend(items, group)
 
-    Create a path for the users prefs files to be stored in their
-    home folder. Create default config files and place them in the relevant
-    directory.
-    """
 
-    print('Setting up dmenu-extended prefs files...')
+    def items(self):
+        """ Yields the items of the cache, those launched before first by
+        their frecency score, then the rest by length. The index at which
+        each of the former was placed is kept in positions.
+        """
+        ranked = sorted(self.ranked, key=lambda entry: (len(entry[1]), entry[0]))
+        ranked.sort(key=lambda entry: self.scores[entry[1]], reverse=True)
+        for index, (group, item) in enumerate(ranked):
+            self.positions.setdefault(item, index)
+            yield item
+        for item in self.sorter.items():
+            yield item
 
-    try:
-        os.makedirs(path_plugins)
-        print('Plugins directory created')
-    except OSError:
-        print('Plugins directory exists - skipped')
 
-    try:
-        os.makedirs(path_cache)
-        print('Cache directory created')
-    except OSError:
-        print('Cache directory exists - skipped')
+    def close_files(self):
+        for f in self.files:
+            f.close()
+        self.files = []
 
-    try:
-        os.makedirs(path_prefs)
-        print('prefs directory created')
-    except OSError:
-        print('prefs directory exists - skipped')
 
-    # If relevant binaries exist, swap them out for the more appropriate items
+    def close(self):
+        self.close_files()
+        self.sorter.close()
 
-    # It has been decided against setting gnome-open or gvfs-open as a default
-    # file handler to prevent intermittent failure to open a text editor
-    # required to edit the configuration file.
 
-    # if os.path.exists('/usr/bin/gnome-open'):
-    #     default_prefs['fileopener'] = 'gnome-open'
-    #     default_prefs['webbrowser'] = 'gnome-open'
-    #     default_prefs['filebrowser'] = 'gnome-open'
-    if os.path.exists('/usr/bin/gnome-terminal'):
-        default_prefs['terminal'] = 'gnome-terminal'
-    if os.path.exists('/usr/bin/urxvt'):
-        default_prefs['terminal'] = 'urxvt'
+class fuzzy_matcher(object):
+    """ Ranks the items of a packed cache against a query
 
-    # Dump the prefs file
-    if os.path.exists(file_prefs) == False:
-        with open(file_prefs,'w') as f:
-            json.dump(default_prefs, f, sort_keys=True, indent=4)
-        print('Preferences file created at: ' + file_prefs)
-    else:
-        print('Existing preferences file found, will not overwrite.')
+    Items containing the query (ignoring ascii case) are found first by
+    searching the lower case copy of the cache with mmap.find. When those
+    do not fill the results, items containing the characters of the query
+    in order are looked for with a regular expression, restricted by the
+    character bitmaps to the blocks of items holding every character of the
+    query.
 
-    # Create package __init__ - for easy access to the plugins
-    with open(path_plugins + '/__init__.py','w') as f:
-        f.write('import os\n')
-        f.write('import glob\n')
-        f.write('__all__ = [ os.path.basename(f)[:-3] for f in glob.glob(os.path.dirname(__file__)+"/*.py")]')
+    Contiguous matches beat scattered ones, matches in the basename beat
+    matches in the path and shorter items beat longer ones. Matches are
+    gathered in cache (priority) order and at most candidate_limit of each
+    kind are scored, so the cost of a query stays bounded however large the
+    cache grows.
+    """
 
+    def __init__(self, cache, candidate_limit=2000):
+        self.cache = cache
+        self.candidate_limit = candidate_limit
+        self.basenames = cache.basenames()
 
-if (os.path.exists(path_plugins + '/__init__.py') and
-    os.path.exists(file_cache) and
-    os.path.exists(file_prefs)):
-    sys.path.append(path_base)
-else:
-    setup_user_files()
-    sys.path.append(path_base)
 
-import plugins
+    def score(self, basename, item, position, span, length):
+        score = 1000 if span == length else 500 - 10 * (span - length)
+        if position >= basename:
+            score += 200
+            if position == basename:
+                score += 100
+        return score - len(item)
 
 
-def load_plugins(debug=False):
-    if debug:
-        print('Loading plugins')
-    plugins_loaded = [{"filename": "plugin_settings.py",
-                       "plugin": extension()}]
-    if debug:
-        plugins_loaded[0]['plugin'].debug = True
+    def item_at(self, position):
+        """ Returns (index, lower case item, item start) for a position
+        within the lower case section.
+        """
+        offsets = self.cache.offsets
+        relative = position - self.cache.lower_offset
+        index = bisect.bisect_right(offsets, relative) - 1
+        start = self.cache.lower_offset + offsets[index]
+        end = self.cache.lower_offset + offsets[index + 1] - 1
+        return index, self.cache.map[start:end], start
 
-    for plugin in plugins.__all__:
-        if plugin not in ['__init__', 'plugin_settings.py']:
-            try:
-                __import__('plugins.' + plugin)
-                exec('plugins_loaded.append({"filename": "' + plugin + '.py", "plugin": plugins.' + plugin + '.extension()})')
-                if debug:
-                    plugins_loaded[-1]['plugin'].debug = True
-                    print('Loaded plugin ' + plugin)
-            except Exception as e:
-                if debug:
-                    print('Error loading plugin ' + plugin)
-                    print(str(e))
-                os.remove(path_plugins + '/' + plugin + '.py')
-                if debug:
-                    print('!! Plugin was deleted to prevent interruption to dmenuExtended')
-    return plugins_loaded
+
+    def blocks(self, query, categories=None):
+        """ Yields (start, end) ranges of the lower case section covering the
+        consecutive blocks that may hold a match, in cache order.
+        """
+        size = packed_cache.block_size
+        mask = (1 << self.cache.blocks) - 1
+        if categories is not None:
+            mask = 0
+            for first, last in self.cache.index_runs(categories):
+                first_block = first // size
+                last_block = (last - 1) // size
+                mask |= ((1 << (last_block - first_block + 1)) - 1) << first_block
+        indexed = bytearray(packed_cache.indexed_characters)
+        for character in set(bytearray(query)):
+            if character in indexed:
+                mask &= self.cache.bitmap(struct.pack('B', character))
+        bits = ''.join(reversed(bin(mask)[2:]))
+        offsets = self.cache.offsets
+        base = self.cache.lower_offset
+        for run in re.finditer('1+', bits):
+            first = run.start() * size
+            last = min(run.end() * size, self.cache.count)
+            yield base + offsets[first], base + offsets[last]
+
+
+    def search(self, query, categories=None, limit=50):
+        """ Returns up to limit items matching query, best first """
+        query = query.encode('utf-8').lower()
+        if len(query) == 0:
+            return []
+        if categories is not None:
+            categories = bytearray(categories)
+        data = self.cache.map
+        scored = []
+        found = set()
+
+        blocks = list(self.blocks(query, categories))
+
+        for start, end in blocks:
+            position = data.find(query, start, end)
+            while position != -1 and len(found) < self.candidate_limit:
+                index, item, item_start = self.item_at(position)
+                if categories is None or bytearray(self.cache.categories[index:index + 1])[0] in categories:
+                    found.add(index)
+                    scored.append((self.score(self.basenames[index], item, position - item_start, len(query), len(query)), -index))
+                position = data.find(query, item_start + len(item) + 1, end)
+
+        characters = [re.escape(query[i:i + 1]) for i in range(len(query))]
+        try:
+            # Possessive quantifiers (Python 3.11+) avoid needless backtracking
+            subsequence = characters[0] + b''.join([b'[^\\n' + x + b']*+' + x for x in characters[1:]])
+            pattern = re.compile(subsequence + b'[^\\n]*')
+        except re.error:
+            subsequence = b'[^\\n]*?'.join(characters)
+            pattern = re.compile(subsequence + b'[^\\n]*')
+        subsequence = re.compile(subsequence)
+
+        if len(scored) < limit:
+            checked = 0
+            for start, end in blocks:
+                for match in pattern.finditer(data, start, end):
+                    index, item, item_start = self.item_at(match.start())
+                    if index in found:
+                        continue
+                    if categories is not None and bytearray(self.cache.categories[index:index + 1])[0] not in categories:
+                        continue
+                    span = subsequence.search(item)
+                    scored.append((self.score(self.basenames[index], item, span.start(), span.end() - span.start(), len(query)), -index))
+                    checked += 1
+                    if checked == self.candidate_limit:
+                        break
+                if checked == self.candidate_limit:
+                    break
+
+        # Items added to the store since the cache was written rank after
+        # cache items of the same score
+        added = self.cache.added_items(categories)
+        for index, item in enumerate(added):
+            lower = item.encode('utf-8').lower()
+            basename = lower.rstrip(b'/').rfind(b'/') + 1
+            position = lower.find(query)
+            if position != -1:
+                scored.append((self.score(basename, lower, position, len(query), len(query)), -self.cache.count - index))
+                continue
+            span = subsequence.search(lower)
+            if span is not None:
+                scored.append((self.score(basename, lower, span.start(), span.end() - span.start(), len(query)), -self.cache.count - index))
+
+        out = []
+        for score, index in heapq.nlargest(limit + len(self.cache.removed), scored):
+            item = self.cache.item(-index) if -index < self.cache.count else added[-index - self.cache.count]
+            if item not in self.cache.removed:
+                out.append(item)
+        return out[:limit]
 
 
 class dmenu(object):
@@ -204,6 +2512,14 @@ class dmenu(object):
     prefs = False
     debug = False
     preCommand = False
+    menu_callback = None
+    binaries_loaded = False
+    scan_limited = {}
+    stats = None
+    trace = None
+    http = None
+    progress = None
+    store_log = b''
 
 
     def get_plugins(self, force=False):
@@ -215,7 +2531,7 @@ class dmenu(object):
         """
 
         if self.plugins_loaded == False:
-            self.plugins_loaded = load_plugins(self.debug)
+            self.plugins_loaded = load_plugins(self.debug, self.get_plugin_host('plugin_import_timeout'))
         elif force:
             if self.debug:
                 print("Forced reloading of plugins")
@@ -229,11 +2545,111 @@ class dmenu(object):
                 from imp import reload
                 reload(plugins)
 
-            self.plugins_loaded = load_plugins(self.debug)
+            self.plugins_loaded = load_plugins(self.debug, self.get_plugin_host('plugin_import_timeout'))
 
         return self.plugins_loaded
 
 
+    def plugin_files(self):
+        """ Returns the modification time of each plugin file by filename """
+
+        mtimes = {}
+        for filename in os.listdir(path_plugins):
+            if filename.endswith('.py') and filename != '__init__.py':
+                try:
+                    mtimes[filename] = os.path.getmtime(path_plugins + '/' + filename)
+                except OSError:
+                    pass
+        return mtimes
+
+
+    def plugins_manifest(self):
+        """ Returns the filename, title, submenu flag and file modification
+        time of every plugin, as recorded when the plugins were last loaded
+
+        This lets a launch match the selection against plugin titles
+        without importing any plugin. Should a plugin file have been added,
+        changed or removed since, the plugins are loaded afresh to rewrite
+        the manifest.
+        """
+
+        manifest = self.load_json(file_cache_plugins_manifest)
+        if manifest != False:
+            recorded = {}
+            for plugin in manifest:
+                if plugin['mtime'] is not None:
+                    recorded[plugin['filename']] = plugin['mtime']
+            if recorded == self.plugin_files():
+                return manifest
+        if self.debug:
+            print('Plugin manifest is missing or out of date')
+        self.plugins_available()
+        return self.load_json(file_cache_plugins_manifest) or []
+
+
+    def plugin_load(self, filename):
+        """ Returns the plugin held in filename, importing that plugin alone
+        unless the plugins have all been loaded already
+        """
+
+        if self.plugins_loaded != False:
+            for plugin in self.plugins_loaded:
+                if plugin['filename'] == filename:
+                    return plugin['plugin']
+        if filename == 'plugin_settings.py':
+            plugin = extension()
+            plugin.prefs = self.prefs
+            plugin.debug = self.debug
+            return plugin
+        plugin = load_plugin(filename[:-3], self.debug)
+        if plugin is None:
+            return False
+        return plugin
+
+
+    def get_plugin_host(self, timeout='plugin_timeout'):
+        """ Returns a plugin_host limited by the timeout preference named
+        and the plugin_memory_limit preference
+        """
+
+        self.load_preferences()
+        return plugin_host(float(self.prefs[timeout]),
+                           int(self.prefs['plugin_memory_limit']),
+                           self.debug)
+
+
+    def plugin_run(self, filename, inputText):
+        """ Runs the plugin held in filename with the input following its
+        title
+
+        Other than the built in settings, plugins are imported and run in
+        a worker of a plugin_host, so one which hangs or crashes is stopped
+        without stalling the launcher. Returns True when the plugin ran
+        successfully.
+        """
+
+        if filename == 'plugin_settings.py':
+            self.plugin_load(filename).run(inputText)
+            return True
+
+        def work():
+            plugin = self.plugin_load(filename)
+            if plugin == False:
+                raise ImportError(filename + ' failed to load and was moved to ' + path_plugins_quarantine)
+            plugin.run(inputText)
+
+        ok, reason = self.get_plugin_host().call(work)
+        if ok == False:
+            if self.debug:
+                print('Plugin ' + filename + ' failed: ' + reason)
+            try:
+                self.menu(['The plugin ' + filename + ' failed:', reason])
+            except SystemExit:
+                # Dismissing the message returns to the caller
+                pass
+        return ok
+
+
     def system_path(self):
         """
         Array containing system paths
@@ -249,16 +2665,14 @@ class dmenu(object):
         except AttributeError:
             pass
 
-        # Split and remove duplicates
-        path = list(set(path.split(':')))
-
-        # Some paths contain an extra separator, remove the empty path
-        try:
-            path.remove('')
-        except ValueError:
-            pass
+        # Split and remove duplicates and empty paths, keeping the order in
+        # which they are searched
+        out = []
+        for item in path.split(':'):
+            if item != '' and item not in out:
+                out.append(item)
 
-        return path
+        return out
 
     def application_paths(self):
         """ Array containing the paths to application flies
@@ -315,6 +2729,10 @@ class dmenu(object):
 
     def load_preferences(self):
         if self.prefs == False:
+            # Store edits are saved to the preferences before they are
+            # logged, so the edits logged by now are all in include_items
+            # (see cache_write_stream)
+            self.store_log = self.store_log_read()
             self.prefs = self.load_json(file_prefs)
 
             if self.prefs == False:
@@ -336,10 +2754,34 @@ class dmenu(object):
         self.save_json(file_prefs, self.prefs)
 
 
+    def get_http(self):
+        """ Returns the http_pool shared by the downloads of this process """
+
+        if dmenu.http is None:
+            self.load_preferences()
+            dmenu.http = http_pool(float(self.prefs['http_timeout']))
+        return dmenu.http
+
+
+    def download_cached(self, url, max_age=None, stale=False, fallback=True):
+        """ Returns the body of url as bytes, through the on disk cache of
+        downloads (see http_cache.get)
+        """
+
+        self.load_preferences()
+        if max_age is None:
+            max_age = float(self.prefs['http_max_age'])
+        return http_cache(self.get_http(), debug=self.debug).get(url, max_age, stale, fallback)
+
+
+    def download(self, url):
+        """ Returns the body of url as bytes """
+
+        return self.get_http().request(url)[2]
+
+
     def connect_to(self, url):
-        request = urllib2.Request(url)
-        response = urllib2.urlopen(request)
-        return response.read().decode(system_encoding)
+        return self.download(url).decode(system_encoding)
 
 
     def download_text(self, url):
@@ -368,6 +2810,8 @@ class dmenu(object):
 
     def menu(self, items, prompt=False):
         self.load_preferences()
+        if self.trace is not None:
+            self.trace.mark('handling')
         if prompt == False:
             p = subprocess.Popen([self.prefs['menu']] + self.prefs['menu_arguments'],
                                  stdin=subprocess.PIPE,
@@ -377,10 +2821,19 @@ class dmenu(object):
                                  stdin=subprocess.PIPE,
                                  stdout=subprocess.PIPE)
 
-        if type(items) == list:
-            items = "\n".join(items)
+        # Let the launcher server know the menu is up (see run_server)
+        if self.menu_callback is not None:
+            callback = self.menu_callback
+            self.menu_callback = None
+            callback()
 
-        out = p.communicate(items.encode(system_encoding))[0]
+        if self.trace is not None:
+            self.trace.mark('menu spawn')
+        self.menu_write(p.stdin, items)
+        out = p.stdout.read()
+        p.wait()
+        if self.trace is not None:
+            self.trace.mark('selection')
 
         if out.strip() == '':
             sys.exit()
@@ -388,6 +2841,51 @@ class dmenu(object):
             return out.decode().strip('\n')
 
 
+    def menu_write(self, stream, items, batch=1000):
+        """ Streams items into the menu's stdin and closes it
+
+        items may be the packed cache, a string, or a list or iterator of
+        strings. Items are written in bounded chunks as they are produced so
+        the menu receives the first (highest priority) items straight away
+        and the whole cache is never held in memory as one string.
+        """
+        try:
+            if isinstance(items, packed_cache):
+                if codecs.lookup(system_encoding).name == 'utf-8':
+                    # The packed cache is stored as utf-8 and is passed on as is
+                    for chunk in items.chunks():
+                        stream.write(chunk)
+                        if self.trace is not None and self.trace.has('first byte') == False:
+                            stream.flush()
+                            self.trace.mark('first byte')
+                else:
+                    self.menu_write(stream, items.items(), batch)
+                    return
+            elif isinstance(items, type('')):
+                stream.write(items.encode(system_encoding))
+            else:
+                pending = []
+                for item in items:
+                    pending.append(item)
+                    if len(pending) == batch:
+                        stream.write(('\n'.join(pending) + '\n').encode(system_encoding))
+                        pending = []
+                if len(pending) > 0:
+                    stream.write('\n'.join(pending).encode(system_encoding))
+            stream.close()
+        except (IOError, OSError) as e:
+            # The menu may exit before reading everything (e.g. a selection
+            # was made while items were still arriving)
+            if e.errno != errno.EPIPE:
+                raise
+            if self.debug:
+                print('The menu closed before all items were written')
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+
+
     def select(self, items, prompt=False, numeric=False):
         result = self.menu(items, prompt)
         for index, item in enumerate(items):
@@ -404,6 +2902,122 @@ class dmenu(object):
         return items
 
 
+    def sort_frecency(self, items):
+        """ Sorts items by length, placing the items found in the launch
+        history first, ordered by their frecency score.
+
+        Each history entry is flagged with whether it is part of the cache
+        so that items which are not need not be looked for at launch.
+        """
+        items = self.sort_shortest(items)
+        if self.prefs['frecency_ranking'] == False:
+            return items
+        history = self.history_load()
+        if len(history) == 0:
+            return items
+        scores = self.history_scores(history)
+        ranked = [item for item in items if item in scores]
+        if len(ranked) > 0:
+            found = set(ranked)
+            ranked.sort(key=lambda x: scores[x], reverse=True)
+            items = ranked + [item for item in items if item not in found]
+        else:
+            found = set()
+        for item, entry in history.items():
+            entry[2] = item in found
+        self.history_save(history)
+        return items
+
+
+    def history_load(self):
+        """ Returns the launch history, a dictionary of
+        item: [score, time of the last launch, whether the item is cached,
+               position of the item in the cache]
+
+        The position is the index of the item among the cache items
+        following the plugins (see packed_cache.promote), or None when it is
+        not known.
+        """
+        try:
+            with codecs.open(file_cache_history, 'r', encoding=system_encoding) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+
+    def history_save(self, history):
+        with codecs.open(file_cache_history + '.tmp', 'w', encoding=system_encoding) as f:
+            json.dump(history, f)
+        os.rename(file_cache_history + '.tmp', file_cache_history)
+
+
+    def history_scores(self, history, now=None):
+        """ Returns the current frecency score of every history item
+
+        A launch is worth 1 and its weight halves every frecency_half_life
+        hours.
+        """
+        if now is None:
+            now = time.time()
+        half_life = float(self.prefs['frecency_half_life']) * 3600
+        scores = {}
+        for item, entry in history.items():
+            scores[item] = entry[0] * 0.5 ** ((now - entry[1]) / half_life)
+        return scores
+
+
+    def history_locate(self, positions):
+        """ Records the positions of the history items placed in the cache,
+        given as a dictionary of item: position
+        """
+        history = self.history_load()
+        for item, entry in history.items():
+            entry[2:] = [item in positions, positions.get(item)]
+        self.history_save(history)
+
+
+    def history_record(self, item, cache=None, size=500):
+        """ Adds a launch of item to the history, keeping the highest
+        scoring size entries. Only the small history file is rewritten.
+
+        The position of an item new to the history is looked up in the
+        packed cache, when given, so that it need not be at launch.
+        """
+        if self.prefs['frecency_ranking'] == False:
+            return
+        now = time.time()
+        history = self.history_load()
+        scores = self.history_scores(history, now)
+        if item in history and len(history[item]) > 3:
+            cached, position = history[item][2:4]
+        elif cache is not None:
+            position = cache.position(item)
+            cached = position is not None
+        else:
+            cached, position = None, None
+        history[item] = [scores.get(item, 0) + 1, now, cached, position]
+        if len(history) > size:
+            scores[item] = history[item][0]
+            for dropped in sorted(scores, key=lambda x: scores[x])[:len(history) - size]:
+                del history[dropped]
+        self.history_save(history)
+
+
+    def history_top(self):
+        """ Returns the frecency_items highest scoring history items that
+        may be in the cache, best first, as (item, position) pairs for
+        packed_cache.promote.
+        """
+        if self.prefs['frecency_ranking'] == False:
+            return []
+        history = self.history_load()
+        scores = self.history_scores(history)
+        candidates = [x for x in scores if history[x][2] != False]
+        candidates.sort(key=lambda x: scores[x], reverse=True)
+        return [(x, history[x][3] if len(history[x]) > 3 else None)
+                for x in candidates[:int(self.prefs['frecency_items'])]]
+
+
     def open_url(self, url):
         self.load_preferences()
         if self.debug:
@@ -428,7 +3042,10 @@ class dmenu(object):
                 f.write('read var;')
 
         os.chmod(os.path.expanduser(sh_command_file), 0o744)
-        os.system(self.prefs['terminal'] + ' -e ' + sh_command_file)
+        if self.trace is not None:
+            self.trace.mark('dispatch')
+            self.trace.save()
+        self.system(self.prefs['terminal'] + ' -e ' + sh_command_file)
 
 
     def open_file(self, path):
@@ -469,7 +3086,25 @@ class dmenu(object):
         if self.preCommand:
             command = self.preCommand + command
 
-        return os.system(command + extra)
+        if self.trace is not None:
+            self.trace.mark('dispatch')
+            self.trace.save()
+
+        return self.system(command + extra)
+
+    def system(self, command):
+        """ Runs command in a shell and returns its exit status, as
+        os.system does
+
+        Within a plugin worker the shell is started by plugin_host.release,
+        so that what it launches neither inherits the worker's memory limit
+        nor is stopped along with the worker.
+        """
+        if plugin_host.in_worker == False:
+            return os.system(command)
+        code = subprocess.Popen(command, shell=True, preexec_fn=plugin_host.release).wait()
+        # Encoded as os.system would
+        return code << 8 if code >= 0 else -code
 
     def cache_regenerate(self, message=True):
         if message:
@@ -481,15 +3116,43 @@ class dmenu(object):
 
 
     def cache_save(self, items, path):
-        with codecs.open(path, 'w',encoding=system_encoding) as f:
-            if type(items) == list:
-                for item in items:
-                    f.write(item+"\n")
-            else:
-                f.write(items)
+        # Written beside path and renamed over it, so that a reader never
+        # sees it half written
+        fd, temp = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            with codecs.open(temp, 'w',encoding=system_encoding) as f:
+                if type(items) == list:
+                    for item in items:
+                        f.write(item+"\n")
+                else:
+                    f.write(items)
+            os.chmod(temp, 0o644)
+            os.rename(temp, path)
+        except:
+            os.remove(temp)
+            raise
         return 1
 
 
+    def cache_read(self, read, attempts=100):
+        """ Returns read(), which reads several cache files, making sure
+        they were all read from the same generation of the cache
+
+        The read is repeated should a cache_set commit while it happens.
+        """
+
+        for attempt in range(attempts):
+            before = cache_generation()
+            if before[1]:
+                time.sleep(0.01)
+                continue
+            out = read()
+            if cache_generation() == before:
+                return out
+        return read()
+
+
     def cache_open(self, path):
         try:
             if self.debug:
@@ -500,8 +3163,8 @@ class dmenu(object):
             return False
 
     def cache_load(self, exitOnFail=False):
-        cache_plugins = self.cache_open(file_cache_plugins)
-        cache_scanned = self.cache_open(file_cache)
+        cache_plugins, cache_scanned = self.cache_read(lambda: (self.cache_open(file_cache_plugins),
+                                                                self.cache_open(file_cache)))
 
         if cache_plugins == False or cache_scanned == False:
             if exitOnFail:
@@ -515,6 +3178,248 @@ class dmenu(object):
 
         return cache_plugins + cache_scanned
 
+    def cache_load_packed(self, exitOnFail=False):
+        """ Returns the packed (memory mapped) cache
+
+        The packed cache is recreated from the text cache files when it is
+        missing, or rebuilt altogether if those do not exist either.
+        """
+        try:
+            generation, committing = cache_generation()
+            cache = packed_cache(file_cache_packed)
+            if committing == False:
+                cache.generation = generation
+            return cache
+        except (IOError, OSError, ValueError, struct.error) as e:
+            if self.debug:
+                print('Could not open the packed cache: ' + str(e))
+
+        if exitOnFail:
+            sys.exit()
+        elif os.path.exists(file_cache) and os.path.exists(file_cache_plugins):
+            self.cache_repack()
+        elif self.cache_regenerate() == False:
+            self.menu(['Error caching data'])
+            sys.exit()
+        return self.cache_load_packed(exitOnFail=True)
+
+    def cache_filter(self, cache, query, categories=None):
+        """ Returns the items of the packed cache matching query, ranked by
+        the fuzzy matcher unless it has been disabled.
+        """
+        self.load_preferences()
+        if self.prefs['fuzzy_matching'] and query != '':
+            return fuzzy_matcher(cache).search(query, categories, int(self.prefs['fuzzy_results']))
+        return cache.search(query, categories)
+
+    def cache_category(self, item):
+        """ Returns the packed_cache category of a (non plugin) cache item """
+        if item[:len(self.prefs['indicator_alias']) + 1] == self.prefs['indicator_alias'] + ' ':
+            return packed_cache.ALIAS
+        elif item[:7] == 'http://' or item[:8] == 'https://' or item == 'rebuild cache':
+            return packed_cache.OTHER
+        elif item[-1:] == '/':
+            return packed_cache.FOLDER
+        elif item.find('/') != -1:
+            return packed_cache.FILE
+        else:
+            return packed_cache.BINARY
+
+    def cache_pack(self, plugins, items, pending=None):
+        """ Writes the packed cache from the plugin titles and cache items,
+        as part of the cache_set pending when given
+        """
+        if pending is None:
+            with cache_set() as pending:
+                return self.cache_pack(plugins, items, pending)
+        writer = packed_cache_writer(pending.path(file_cache_packed))
+        writer.extend(plugins, packed_cache.PLUGIN)
+        for item in items:
+            writer.add(item, self.cache_category(item))
+        writer.close()
+
+    def cache_repack(self, plugins=None, pending=None):
+        """ Recreates the packed cache from the text cache files """
+        self.load_preferences()
+        if plugins is None:
+            plugins, items = self.cache_read(lambda: (self.cache_open(file_cache_plugins),
+                                                      self.cache_open(file_cache)))
+            plugins = plugins.split('\n')[:-1] if plugins else []
+        else:
+            items = self.cache_open(file_cache)
+        items = items.split('\n')[:-1] if items else []
+        self.cache_pack(plugins, items, pending)
+
+    def cache_overlay(self, cache):
+        """ Applies the store log to the packed cache """
+        self.load_preferences()
+        added, removed = self.store_log_load()
+        if len(added) > 0 or len(removed) > 0:
+            indexes = self.store_log_locate(cache, added + sorted(removed))
+            cache.overlay([(x, self.cache_category(x)) for x in added], removed, indexes)
+
+    def store_log_locate(self, cache, items):
+        """ Returns a dictionary of item: index of where the edited items
+        are in the packed cache, -1 for those not in it (see
+        packed_cache.locate)
+
+        Each item is looked for once in each generation of the cache: the
+        indexes found are kept in file_cache_store_index for the launches
+        that follow.
+        """
+        try:
+            with open(file_cache_store_index, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = {}
+        known = {}
+        if state.get('generation') == cache.generation and cache.generation is not None:
+            known = state.get('indexes', {})
+        indexes = {}
+        missing = False
+        for item in items:
+            if item not in known:
+                missing = True
+                index = cache.index(item)
+                known[item] = -1 if index is None else index
+            indexes[item] = known[item]
+        if missing and cache.generation is not None:
+            temp = file_cache_store_index + '.' + str(os.getpid()) + '.new'
+            try:
+                with open(temp, 'w') as f:
+                    json.dump({'generation': cache.generation, 'indexes': indexes}, f)
+                os.rename(temp, file_cache_store_index)
+            except (IOError, OSError):
+                if self.debug:
+                    print('Could not save the indexes of the store edits')
+        return indexes
+
+    def cache_compact(self):
+        """ Folds the store log into the text and packed caches """
+        with cache_lock():
+            head = self.store_log_read()
+        added, removed = self.store_log_load(head)
+        plugins, items = self.cache_read(lambda: (self.cache_open(file_cache_plugins),
+                                                  self.cache_open(file_cache)))
+        if items == False:
+            return
+        plugins = plugins.split('\n')[:-1] if plugins else []
+        items = [x for x in items.split('\n')[:-1] if x not in removed]
+        present = set(items)
+        items = [x for x in added if x not in present] + items
+        with cache_set() as pending:
+            self.cache_save(items, pending.path(file_cache))
+            self.cache_pack(plugins, items, pending)
+            pending.cut(file_cache_store_log, head)
+        # The added items come first, moving the rest along
+        if self.prefs['frecency_ranking']:
+            history = self.history_load()
+            positions = {}
+            for index, item in enumerate(items):
+                if item in history:
+                    positions.setdefault(item, index)
+            self.history_locate(positions)
+
+    def store_log_parse(self, line):
+        """ Returns (action, item, number, generation) for a line of the
+        store log
+
+        Each edit is logged as the action and item followed by a tab, the
+        number of the edit and the generation of the cache it was made
+        against. Lines logged without these give None for them.
+        """
+        match = re.search(r'\t(\d+) (-?\d+)(?: -?\d+)?$', line)
+        if match is None:
+            return line[:1], line[1:], None, None
+        return line[:1], line[1:match.start()], int(match.group(1)), int(match.group(2))
+
+    def store_log_read(self):
+        """ Returns the whole lines of the store log, as bytes
+
+        Edits are appended a line at a time, so a line still being written
+        is left out rather than waited for.
+        """
+        try:
+            with open(file_cache_store_log, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return b''
+        return data[:data.rfind(b'\n') + 1]
+
+    def store_log_load(self, data=None):
+        """ Returns the items added to and removed from the store since the
+        cache was written, by replaying the store log (or the lines of it
+        given as data).
+        """
+        added = []
+        removed = set()
+        if data is None:
+            data = self.store_log_read()
+        for line in data.decode(system_encoding).split('\n')[:-1]:
+            action, item = self.store_log_parse(line)[:2]
+            if action == '+':
+                removed.discard(item)
+                if item not in added:
+                    added.append(item)
+            elif action == '-':
+                if item in added:
+                    added.remove(item)
+                removed.add(item)
+        return added, removed
+
+    def store_log_edits(self):
+        """ Returns the numbers of the first and last edits in the store log,
+        reading only its first and last lines, or None when it is empty.
+        """
+        try:
+            with open(file_cache_store_log, 'rb') as f:
+                first = f.readline()
+                f.seek(0, 2)
+                position = f.tell()
+                tail = b''
+                while position > 0 and tail.count(b'\n') < 2:
+                    step = min(4096, position)
+                    position -= step
+                    f.seek(position)
+                    tail = f.read(step) + tail
+        except (IOError, OSError):
+            return None
+        if first == b'':
+            return None
+        last = tail.split(b'\n')[-2]
+        numbers = [self.store_log_parse(x.decode('utf-8').rstrip('\n'))[2] for x in [first, last]]
+        if None in numbers:
+            # Logged without numbers, so they are counted
+            with open(file_cache_store_log, 'rb') as f:
+                return 1, f.read().count(b'\n')
+        return numbers[0], numbers[1]
+
+    def store_log_append(self, action, item):
+        """ Records an item added to ('+') or removed from ('-') the store
+
+        Edits are appended to the store log and applied whenever the cache is
+        loaded. Once the log holds store_log_compact edits it is folded into
+        the cache.
+        """
+        self.load_preferences()
+        # A cache_set cutting the log must not lose the edit. The item is
+        # looked for in the cache when it is next loaded (store_log_locate)
+        # rather than here, so an edit costs the same however large the
+        # cache is.
+        with cache_lock():
+            generation = cache_generation()[0]
+            numbers = self.store_log_edits()
+            if numbers is None:
+                first, number = 1, 1
+            else:
+                first, number = numbers[0], numbers[1] + 1
+            with codecs.open(file_cache_store_log, 'a', encoding=system_encoding) as f:
+                f.write(action + item + '\t' + str(number) + ' ' + str(generation) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        if number - first + 1 >= int(self.prefs['store_log_compact']):
+            self.cache_compact()
+
     def command_output(self, command, split=True):
         if type(command) != list:
             command = command.split(" ")
@@ -527,80 +3432,250 @@ class dmenu(object):
         else:
             return out
 
-    def scan_binaries(self):
-        out = []
-        for path in self.system_path():
-            if not os.path.exists(path):
+    def binaries_index(self, refresh=False):
+        """ Returns a dictionary mapping each binary name on the PATH to the
+        directory it resolves to
+
+        The listing of every PATH directory is kept on disk along with its
+        mtime, so only directories that have changed since the last call are
+        read again. The result is kept for the life of this object unless
+        refresh is set.
+        """
+        if self.binaries_loaded != False and refresh == False:
+            return self.binaries_loaded
+
+        try:
+            with codecs.open(file_cache_path_index, 'r', encoding=system_encoding) as f:
+                known = json.load(f)
+        except (IOError, OSError, ValueError):
+            known = {}
+
+        paths = self.system_path()
+        listings = {}
+        changed = False
+        for path in paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
                 continue
-            for binary in os.listdir(path):
-                if binary[:3] is not 'gpk':
-                    out.append(binary)
-        return out
+            entry = known.get(path)
+            if entry is None or entry[0] != mtime:
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    continue
+                entry = [mtime, names]
+                changed = True
+            listings[path] = entry
+
+        if changed or len(listings) != len(known):
+            # Written beside the index and renamed over it, so that it is
+            # never seen half written
+            try:
+                fd, temp = tempfile.mkstemp(prefix='.' + os.path.basename(file_cache_path_index), dir=path_cache)
+                os.close(fd)
+                try:
+                    with codecs.open(temp, 'w', encoding=system_encoding) as f:
+                        json.dump(listings, f)
+                    os.rename(temp, file_cache_path_index)
+                except:
+                    os.remove(temp)
+                    raise
+            except (IOError, OSError):
+                if self.debug:
+                    print('Could not save the index of the PATH directories')
+
+        # Earlier directories on the PATH take precedence, as in the shell
+        index = {}
+        for path in reversed(paths):
+            if path in listings:
+                index.update(dict.fromkeys(listings[path][1], path))
+
+        self.binaries_loaded = index
+        return index
+
+    def has_binary(self, name):
+        return name in self.binaries_index()
+
+    def scan_binaries(self, refresh=False):
+        return list(self.binaries_index(refresh))
 
     def format_alias(self, name, command):
         return self.prefs['indicator_alias'] + ' ' + self.prefs['aliased_applications_format'].format(name=name, command=command)
 
+    def locale_keys(self):
+        """ Returns the localised Name keys to look for in .desktop files,
+        most specific first, as described by the desktop entry specification.
+        """
+        value = ''
+        for variable in ['LC_ALL', 'LC_MESSAGES', 'LANG']:
+            value = os.environ.get(variable, '')
+            if value != '':
+                break
+        value, at, modifier = value.partition('@')
+        value = value.split('.')[0]
+        language, underscore, country = value.partition('_')
+        keys = []
+        if language in ['', 'C', 'POSIX']:
+            return keys
+        if country and modifier:
+            keys.append('Name[' + language + '_' + country + '@' + modifier + ']')
+        if country:
+            keys.append('Name[' + language + '_' + country + ']')
+        if modifier:
+            keys.append('Name[' + language + '@' + modifier + ']')
+        keys.append('Name[' + language + ']')
+        return keys
+
+    def parse_desktop_file(self, pathname):
+        """ Returns the keys of the [Desktop Entry] group of a .desktop file
+        that are of interest (Exec, Name and its localised variants,
+        Terminal, NoDisplay, Hidden and Type) as a dictionary, or None if
+        the file can not be read.
+        """
+        entry = {}
+        in_group = False
+        try:
+            with codecs.open(pathname, 'r', encoding=system_encoding, errors='replace') as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('['):
+                        if in_group:
+                            break
+                        in_group = line == '[Desktop Entry]'
+                    elif in_group and line.find('=') != -1 and line.startswith('#') == False:
+                        key, value = line.split('=', 1)
+                        key = key.strip()
+                        if key in ['Exec', 'Terminal', 'NoDisplay', 'Hidden', 'Type'] or key.startswith('Name'):
+                            entry[key] = value.strip()
+        except (IOError, OSError):
+            return None
+        return entry
+
+    def load_desktop_cache(self):
+        try:
+            with codecs.open(file_cache_desktop, 'r', encoding=system_encoding) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
     def scan_applications(self):
-        paths = self.system_path()
-        applications = []
+        """ Returns the applications described by the .desktop files
+
+        Parsed files are kept in a cache keyed by their path, mtime and size
+        so that only new or modified files are read, several at a time. As
+        in the desktop entry specification, the first file found with a
+        given name takes precedence and entries marked Hidden or NoDisplay
+        are left out.
+        """
+        self.load_preferences()
+        paths = set([x.rstrip('/') for x in self.system_path()])
+
+        files = []
+        seen = set()
         for app_path in self.application_paths():
-            for filename in os.listdir(app_path):
-                pathname = os.path.join(app_path,filename)
-                if os.path.isfile(pathname):
-                    # Open the application file using the system's preferred encoding (probably utf-8)
-                    with codecs.open(pathname,'r',encoding=system_encoding) as f:
-                        name = None
-                        command = None
-                        terminal = None
-                        for line in f.readlines():
-                            if line[0:5] == 'Exec=':
-                                command_tmp = line[5:-1].split()
-                                command = ''
-                                space = ''
-                                for piece in command_tmp:
-                                    if piece.find('%') == -1:
-                                        command += space + piece
-                                        space = ' '
-                                    else:
-                                        break
-                            elif line[0:5] == 'Name=':
-                                name = line[5:-1]
-                            elif line[0:9] == 'Terminal=':
-                                if line[9:-1].lower() == 'true':
-                                    terminal = True
-                                else:
-                                    terminal = False
-                            if name is not None and command is not None:
-                                if terminal is None:
-                                    terminal = False
-                                for path in paths:
-                                    if command[0:len(path)] == path:
-                                        if command[len(path)+1:].find('/') == -1:
-                                            command = command[len(path)+1:]
-
-                                applications.append({
-                                                    'name': name,
-                                                    'command': command,
-                                                    'terminal': terminal,
-                                                    'descriptor': filename.replace('.desktop','')
-                                                    })
-                                break
+            try:
+                filenames = sorted(os.listdir(app_path))
+            except OSError:
+                continue
+            for filename in filenames:
+                if filename.endswith('.desktop') == False or filename in seen:
+                    continue
+                pathname = os.path.join(app_path, filename)
+                try:
+                    info = os.stat(pathname)
+                except OSError:
+                    continue
+                if stat.S_ISREG(info.st_mode):
+                    seen.add(filename)
+                    files.append((pathname, filename, info.st_mtime, info.st_size))
+
+        known = self.load_desktop_cache()
+        parsed = {}
+        stale = []
+        for pathname, filename, mtime, size in files:
+            if pathname in known and known[pathname][:2] == [mtime, size]:
+                parsed[pathname] = known[pathname]
+            else:
+                stale.append((pathname, mtime, size))
+
+        if self.debug:
+            print(str(len(files)) + ' application files found, ' + str(len(stale)) + ' of them to be parsed')
+
+        if len(stale) > 0:
+            pool = ThreadPool(max(1, int(self.prefs['scan_workers'])))
+            try:
+                entries = pool.map(self.parse_desktop_file, [x[0] for x in stale])
+            finally:
+                pool.close()
+                pool.join()
+            for (pathname, mtime, size), entry in zip(stale, entries):
+                parsed[pathname] = [mtime, size, entry]
+
+        if len(stale) > 0 or len(parsed) != len(known):
+            with codecs.open(file_cache_desktop, 'w', encoding=system_encoding) as f:
+                json.dump(parsed, f)
+
+        name_keys = self.locale_keys() + ['Name']
+        applications = []
+        for pathname, filename, mtime, size in files:
+            entry = parsed[pathname][2]
+            if entry is None or 'Exec' not in entry:
+                continue
+            if entry.get('Hidden', '').lower() == 'true' or entry.get('NoDisplay', '').lower() == 'true':
+                continue
+            if entry.get('Type', 'Application') != 'Application':
+                continue
+
+            name = None
+            for key in name_keys:
+                if key in entry:
+                    name = entry[key]
+                    break
+            if name is None:
+                continue
+
+            command = ''
+            space = ''
+            for piece in entry['Exec'].split():
+                if piece.find('%') == -1:
+                    command += space + piece
+                    space = ' '
+                else:
+                    break
+
+            # Refer to binaries on the path by their name alone
+            slash = command.rfind('/')
+            if slash != -1 and command[:slash] in paths:
+                command = command[slash + 1:]
+
+            applications.append({
+                                'name': name,
+                                'command': command,
+                                'terminal': entry.get('Terminal', '').lower() == 'true',
+                                'descriptor': filename.replace('.desktop', '')
+                                })
         return applications
 
     def retrieve_aliased_command(self, alias):
         """
         Return the command intended to be executed by the given alias.
         """
-        aliases = self.load_json(file_cache_aliasesLookup)
         if self.debug:
             print("Converting '" + str(alias) + "' into its aliased command")
-        for item in aliases:
-            if item[0] == alias:
-                return item[1]
+        store = alias_store()
+        try:
+            command = store.get(alias)
+        except sqlite3.Error:
+            command = None
+        finally:
+            store.close()
+        if command is not None:
+            return command
         if self.debug:
             print("No suitable candidate was found")
 
-    def plugins_available(self):
+    def plugins_available(self, repack=True, pending=None):
         self.load_preferences()
         if self.debug:
             print('Loading available plugins...')
@@ -622,10 +3697,31 @@ class dmenu(object):
             print('')
 
         out = self.sort_shortest(plugin_titles)
-        self.cache_save(out, file_cache_plugins)
+
+        mtimes = self.plugin_files()
+        manifest = []
+        for plugin in plugins:
+            manifest.append({'filename': plugin['filename'],
+                             'title': plugin['plugin'].title,
+                             'is_submenu': bool(getattr(plugin['plugin'], 'is_submenu', False)),
+                             'mtime': mtimes.get(plugin['filename'])})
+
+        if pending is None:
+            with cache_set() as pending:
+                self.plugins_save(out, manifest, repack, pending)
+        else:
+            self.plugins_save(out, manifest, repack, pending)
 
         return out
 
+    def plugins_save(self, titles, manifest, repack, pending):
+        self.cache_save(titles, pending.path(file_cache_plugins))
+        self.save_json(pending.path(file_cache_plugins_manifest), manifest)
+
+        # Keep the plugins held in the packed cache in step
+        if repack and os.path.exists(file_cache_packed):
+            self.cache_repack(titles, pending)
+
     def try_remove(self, needle, haystack):
         """
         Gracefully try to remove an item from an array. It not found, fire no
@@ -636,26 +3732,178 @@ class dmenu(object):
         except ValueError:
             pass
 
+    def cache_rebuild(self):
+        """ Rebuilds the cache, returning lines describing how it changed """
+        if self.debug:
+            print('Counting items in original cache')
+
+        try:
+            cache = packed_cache(file_cache_packed)
+            cacheSize = len(cache)
+            cache.close()
+        except (IOError, OSError, ValueError, struct.error):
+            cacheSize = 0
+
+        if self.debug:
+            print('Rebuilding the cache...')
+        result = self.cache_regenerate(message=False)
+        if self.debug:
+            print('Cache built')
+            print('Counting items in new cache')
+        newSize = self.stats.counters.get('items', 0) if self.stats is not None else 0
+        if self.debug:
+            print('New cache size = ' + str(newSize))
+        cacheSizeChange = newSize - cacheSize
+        if self.debug:
+            if cacheSizeChange != 0:
+                print('This differs from original by ' + str(cacheSizeChange) + ' items')
+            else:
+                print('Cache size did not change')
+
+        response = []
+
+        if cacheSizeChange != 0:
+            if cacheSizeChange == 1:
+                status = 'one new item was added.'
+            elif cacheSizeChange == -1:
+                status = 'one item was removed.'
+            elif cacheSizeChange > 0:
+                status = str(cacheSizeChange) + ' items were added.'
+            elif cacheSizeChange < 0:
+                status = str(abs(cacheSizeChange)) + ' items were removed.'
+            else:
+                status = 'No new items were added'
+
+            response.append('Cache updated successfully; ' + status)
+
+            if result == 2:
+                response.append('NOTICE: Performance issues were encountered while caching data')
+
+        else:
+            response.append('Cache rebuilt; its size did not change.')
+
+        response.append('The cache contains ' + str(newSize) + ' items.')
+
+        for root, reason in sorted(self.scan_limited.items()):
+            response.append('NOTICE: Stopped scanning ' + root + ' on reaching its ' + reason)
+
+        return response
+
+
+    def cache_rebuild_background(self):
+        """ Starts a rebuild of the cache in a detached process of low
+        priority, unless one is running already
+
+        The rebuild reports its progress to the status file, see
+        rebuild_progress. Returns the pid of the rebuild, or None when one
+        was running already or it could not be started.
+        """
+        state = rebuild_state()
+        if state is not None and state['state'] == 'running':
+            return None
+        path = os.path.abspath(__file__)
+        if path.endswith('.pyc'):
+            path = path[:-1]
+        command = [sys.executable, path, '--rebuild']
+        if self.has_binary('ionice'):
+            command = ['ionice', '-c', '3'] + command
+        # Started from a child which exits at once, so that the rebuild is
+        # never left behind as a zombie of this process. The child passes
+        # back the pid of the rebuild.
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read)
+                with open(os.devnull, 'r+') as devnull:
+                    rebuild = subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull,
+                                               close_fds=True, preexec_fn=os.setsid)
+                os.write(write, str(rebuild.pid).encode('ascii'))
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read, 'rb') as f:
+            rebuild = f.read()
+        try:
+            os.waitpid(pid, 0)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+        if rebuild == b'':
+            return None
+        return int(rebuild)
+
+
+    def rebuild_progress(self, pid=None):
+        """ Shows the progress of the background rebuild, refreshed for as
+        long as Refresh is picked
+
+        When the pid of a rebuild just started is given, it is shown as
+        starting until it first writes the status file, which still holds
+        the state of the previous rebuild, or reported as failed should it
+        exit before then.
+        """
+        started = time.time()
+        while True:
+            state = rebuild_state()
+            if pid is not None and (state is None or state.get('pid') != pid):
+                if process_alive(pid):
+                    lines = ['Starting the rebuild, ' + duration_text(time.time() - started) + ' so far']
+                    if self.menu(lines + ['Refresh'], 'Rebuild:') != 'Refresh':
+                        return
+                    continue
+                # It may have written the status file just before exiting
+                state = rebuild_state()
+                if state is None or state.get('pid') != pid:
+                    self.menu(['The last rebuild failed: it stopped before reporting its progress'])
+                    return
+            if state is None:
+                self.menu(['The cache has not been rebuilt in the background yet'])
+                return
+            lines = rebuild_report(state)
+            if state['state'] != 'running':
+                self.menu(lines)
+                return
+            if self.menu(lines + ['Refresh'], 'Rebuild:') != 'Refresh':
+                return
+
+
     def cache_build(self):
         self.load_preferences()
+        self.stats = build_stats()
 
-        valid_extensions = []
-        if 'valid_extensions' in self.prefs:
-            for extension in self.prefs['valid_extensions']:
-                if extension == '*':
-                    valid_extensions = True
-                    break
-                elif extension == '':
-                    valid_extensions.append('')
-                elif extension[0] != '.':
-                    extension = '.' + extension
-                valid_extensions.append(extension.lower())
+        if self.progress is not None:
+            self.progress.update(stage='applications')
+        binaries, aliased_items, aliases = self.cache_build_applications()
 
+        # The files and folders go straight to their cache files as they
+        # are found, rather than being gathered up first
+        scanner = folder_scanner(self.prefs, self.debug)
+        with cache_set() as pending:
+            stream = self.cache_stream(pending)
+            try:
+                self.cache_scan_folders(scanner, stream.sink(file_cache_files, cache_stream.FILE),
+                                        stream.sink(file_cache_folders, cache_stream.FOLDER))
+                if self.progress is not None:
+                    self.progress.update(True, stage='write')
+                self.cache_write_stream(stream, binaries, aliased_items, aliases)
+            finally:
+                stream.close()
+            # The files are synced and renamed into place on leaving
+            self.stats.start('write')
+        self.stats.stop('write')
+        return self.cache_written()
+
+
+    def cache_build_applications(self):
+        """ Returns (binaries, aliased_items, aliases) for the cache
+
+        Scans the binaries on the path and the .desktop application files
+        according to the preferences. Like the other stages of a build it is
+        timed in self.stats, which cache_build (or the daemon) sets up.
+        """
         applications = []
 
-        # Holds what binaries have been found
-        binaries = []
-
         # Holds the directly searchable "# Htop (htop;)" lines
         aliased_items = []
 
@@ -665,109 +3913,165 @@ class dmenu(object):
         # If we're going to include the applications or we want them for
         # filtering purposes, scan the .desktop files and get the applications
         if self.prefs['include_applications'] or self.prefs['filter_binaries']:
+            self.stats.start('desktop scan')
             applications = self.scan_applications()
+            self.stats.stop('desktop scan')
+            self.stats.count('applications', len(applications))
 
         # Do we want to add binaries into the cache?
+        self.stats.start('binary scan')
         if self.prefs['include_binaries'] is True:
             if self.prefs['filter_binaries'] is True:
-                binaries_raw = self.scan_binaries()
+                binaries_raw = self.binaries_index(True)
                 filterlist = [x['command'] for x in applications] + [x['descriptor'] for x in applications]
-                for item in filterlist:
-                    if item in binaries_raw:
-                        binaries.append(item)
+                binaries = set([x for x in filterlist if x in binaries_raw])
             else:
-                binaries = self.scan_binaries()
-
-        binaries = list(set(binaries))
+                binaries = set(self.scan_binaries(True))
+        else:
+            binaries = set()
+        self.stats.stop('binary scan')
 
         # Do we want to add applications from .desktop files into the cache?
+        self.stats.start('aliasing')
         if self.prefs['include_applications']:
             if self.prefs['alias_applications']:
-                if os.path.exists(file_cache_aliases):
-                    os.remove(file_cache_aliases)
                 for app in applications:
                     command = app['command']
                     if app['terminal']:
                         command += ';'
                     if app['name'].lower() != app['command'].lower():
                         title = self.format_alias(app['name'], command)
-                        self.try_remove(app['command'], binaries)
+                        binaries.discard(app['command'])
                         aliased_items.append(title)
                         aliases.append([title, command])
                     else:
-                        binaries.append(command)
+                        binaries.add(command)
                     if app['terminal']:
                         # Remove any non-terminal invoking versions from cache
-                        self.try_remove(app['command'], binaries)
+                        binaries.discard(app['command'])
             else:
                 for app in applications:
                     command = app['command']
                     # Add the "run in terminal" indicator to the command
                     if app['terminal']:
                         command += ';'
-                    binaries.append(command)
+                    binaries.add(command)
                     # Remove any non-terminal invoking versions from cache
                     if app['terminal']:
-                        self.try_remove(app['command'], binaries)
+                        binaries.discard(app['command'])
+
+        binaries = list(binaries)
+        self.stats.stop('aliasing')
+        self.stats.count('binaries', len(binaries))
 
-        binaries = list(set(binaries))
+        return binaries, aliased_items, aliases
 
+
+    def get_watch_folders(self):
         watch_folders = []
         if 'watch_folders' in self.prefs:
-            watch_folders = self.prefs['watch_folders']
-        watch_folders = map(lambda x: x.replace('~', os.path.expanduser('~')), watch_folders)
-
-        if self.debug:
-            print('Done!')
-            print('Watch folders:')
-            print('Loading the list of folders to be excluded from the index...')
+            # Entries with per folder limits are dictionaries holding a path
+            watch_folders = [x.get('path', '') if type(x) == dict else x for x in self.prefs['watch_folders']]
+        return list(map(lambda x: x.replace('~', os.path.expanduser('~')), watch_folders))
 
-        ignore_folders = []
 
-        if 'ignore_folders' in self.prefs:
-            for exclude_folder in self.prefs['ignore_folders']:
-                ignore_folders.append(exclude_folder.replace('~', os.path.expanduser('~')))
+    def cache_scan_folders(self, scanner, filenames=None, foldernames=None):
+        """ Returns (filenames, foldernames) found in the watch folders,
+        which are added to the given lists (or sinks) if any
+        """
+        watch_folders = self.get_watch_folders()
 
         if self.debug:
             print('Done!')
             print('Excluded folders:')
             print('First 5 items: ')
-            print(ignore_folders[:5])
-            print(str(len(ignore_folders)) + ' ignore_folders loaded in total')
+            print(list(scanner.ignore_folders)[:5])
+            print(str(len(scanner.ignore_folders)) + ' ignore_folders loaded in total')
             print('')
 
-        filenames = []
-        foldernames = []
+            if scanner.follow_symlinks:
+                print('Indexing will follow linked folders')
+            else:
+                print('Indexing will not follow linked folders')
+
+            print('Scanning files and folders with ' + str(scanner.workers) + ' workers, this may take a while...')
 
-        follow_symlinks = False
-        try:
-            if 'follow_symlinks' in self.prefs:
-                follow_symlinks = self.prefs['follow_symlinks']
-        except:
-            pass
+        if self.prefs['incremental_rebuild']:
+            scanner.load_manifest(file_cache_manifest)
+
+        if self.progress is not None:
+            scanner.progress = lambda root, folders, files: self.progress.update(stage='walk', root=root,
+                                                                                 folders=folders, files=files)
+        self.stats.start('walk')
+        filenames, foldernames = scanner.scan(watch_folders, filenames, foldernames)
+        self.stats.stop('walk')
+
+        if self.prefs['incremental_rebuild']:
+            scanner.save_manifest(file_cache_manifest)
+        elif os.path.exists(file_cache_manifest):
+            os.remove(file_cache_manifest)
 
         if self.debug:
-            if follow_symlinks:
-                print('Indexing will not follow linked folders')
-            else:
-                print('Indexing will follow linked folders')
+            print(str(scanner.listed) + ' folders scanned, ' + str(scanner.reused) + ' of them unchanged since the last scan')
+
+        self.scan_limited = dict(scanner.limited)
+        self.stats.count('folders scanned', scanner.listed)
+        self.stats.count('folders reused', scanner.reused)
+        for root, entry in scanner.root_stats.items():
+            self.stats.roots[root] = dict(entry, limited=scanner.limited.get(root))
+
+        return filenames, foldernames
+
 
-            print('Scanning files and folders, this may take a while...')
+    def cache_stream(self, pending):
+        """ Returns the cache_stream for a build written to the cache_set
+        pending, leaving out the excluded items and ranking the items
+        launched before
+        """
+        exclude = []
+        if 'exclude_items' in self.prefs:
+            exclude = [x for x in self.prefs['exclude_items'] if type(x) != list]
+        scores = {}
+        if self.prefs['frecency_ranking']:
+            history = self.history_load()
+            if len(history) > 0:
+                scores = self.history_scores(history)
+        return cache_stream(pending, exclude, scores, int(self.prefs['build_run_size']))
 
-        for watchdir in watch_folders:
-            for root, dirs , files in os.walk(watchdir, followlinks=follow_symlinks):
-                dirs[:] = [d for d in dirs if os.path.join(root,d) not in ignore_folders]
 
-                if self.prefs['scan_hidden_folders'] or root.find('/.')  == -1:
-                    for name in files:
-                        if self.prefs['include_hidden_files'] or name.startswith('.') == False:
-                            if valid_extensions == True or os.path.splitext(name)[1].lower() in valid_extensions:
-                                filenames.append(os.path.join(root,name))
-                    for name in dirs:
-                        if self.prefs['include_hidden_folders'] or name.startswith('.') == False:
-                            foldernames.append(os.path.join(root,name) + '/')
+    def cache_write(self, binaries, aliased_items, aliases, foldernames, filenames, plugins=None):
+        """ Writes the cache files from the scanned items and returns the
+        number of menu items.
+
+        The titles of the plugins are collected unless they are given.
+        """
+        # The daemon gathers the statistics of its scans beforehand
+        if self.stats is None:
+            self.stats = build_stats()
+        with cache_set() as pending:
+            stream = self.cache_stream(pending)
+            try:
+                stream.sink(file_cache_folders, cache_stream.FOLDER).extend(foldernames)
+                stream.sink(file_cache_files, cache_stream.FILE).extend(filenames)
+                self.cache_write_stream(stream, binaries, aliased_items, aliases, plugins)
+            finally:
+                stream.close()
+            # The files are synced and renamed into place on leaving
+            self.stats.start('write')
+        self.stats.stop('write')
+        return self.cache_written()
+
+
+    def cache_write_stream(self, stream, binaries, aliased_items, aliases, plugins=None):
+        """ Adds the applications, binaries and included items to the
+        cache_stream holding the folders and files, and writes the full
+        text and packed caches from it.
+        """
+        self.stats.start('dedupe')
 
-        foldernames = list(filter(lambda x: x not in ignore_folders, foldernames))
+        binaries = list(binaries)
+        aliased_items = list(aliased_items)
+        aliases = list(aliases)
 
         include_items = []
 
@@ -790,40 +4094,69 @@ class dmenu(object):
 
         # Remove any manually added include items differing by a colon
         # e.g. ["htop", "htop;"] becomes just ["htop;"]
-        for item in include_items:
-            if item[-1] == ';' and item[0:-1] in binaries:
-                binaries.remove(item[0:-1])
-
-        plugins = self.plugins_available()
+        in_terminal = set([item[:-1] for item in include_items if item[-1:] == ';'])
+        if len(in_terminal) > 0:
+            binaries = [x for x in binaries if x not in in_terminal]
 
-        # Save the alias lookup file and aliased_items
-        self.save_json(file_cache_aliasesLookup, aliases)
-        self.cache_save(aliased_items, file_cache_aliases)
-        self.cache_save(binaries, file_cache_binaries)
-        self.cache_save(foldernames, file_cache_folders)
-        self.cache_save(filenames, file_cache_files)
-
-        other = self.sort_shortest(include_items + aliased_items + binaries + foldernames + filenames)
-
-        if 'exclude_items' in self.prefs:
-            for item in self.prefs['exclude_items']:
-                try:
-                    other.remove(item)
-                except ValueError:
-                    pass
+        self.stats.stop('dedupe')
 
-        other += ['rebuild cache']
-        self.cache_save(other, file_cache)
+        if plugins is None:
+            self.stats.start('plugins')
+            plugins = self.plugins_available(repack=False, pending=stream.pending)
+            self.stats.stop('plugins')
 
-        out = plugins
-        out += other
+        # Save the alias lookup file and aliased_items
+        self.stats.start('write')
+        alias_store(stream.pending.path(file_cache_aliases_store)).replace(aliases)
+        stream.sink(file_cache_aliases, cache_stream.ALIASED).extend(aliased_items)
+        stream.sink(file_cache_binaries, cache_stream.BINARY).extend(binaries)
+        for item in include_items:
+            stream.add(item, cache_stream.INCLUDED)
+        stream.close_files()
+        self.stats.stop('write')
+
+        # The runs of the sorter are merged while the caches are written
+        self.stats.start('sort')
+        with codecs.open(stream.pending.path(file_cache), 'w', encoding=system_encoding) as f:
+            def written(items):
+                lines = []
+                for item in items:
+                    lines.append(item)
+                    if len(lines) == 4096:
+                        f.write('\n'.join(lines) + '\n')
+                        lines = []
+                    yield item
+                if len(lines) > 0:
+                    f.write('\n'.join(lines) + '\n')
+            self.cache_pack(plugins, written(itertools.chain(stream.items(), ['rebuild cache'])), stream.pending)
+        self.stats.stop('sort')
+
+        # Record where the history entries were placed in the cache, so
+        # that they need not be looked for at launch
+        if len(stream.scores) > 0:
+            self.history_locate(stream.positions)
+
+        # The store edits logged before the preferences were loaded are part
+        # of include_items, those logged since are kept
+        stream.pending.cut(file_cache_store_log, self.store_log)
+        self.stats.count('items', len(plugins) + stream.count + 1)
+
+
+    def cache_written(self):
+        """ Records the statistics of the build whose cache files were just
+        put in place, returning the number of menu items
+        """
+        written = [file_cache_aliases_store, file_cache_aliases, file_cache_binaries,
+                   file_cache_folders, file_cache_files, file_cache, file_cache_packed]
+        self.stats.count('bytes written', sum([os.path.getsize(x) for x in written if os.path.exists(x)]))
+        self.stats.save(file_cache_stats)
 
         if self.debug:
             print('Done!')
             print('Cache building has finished.')
             print('')
 
-        return out
+        return self.stats.counters['items']
 
 
 class extension(dmenu):
@@ -831,70 +4164,23 @@ class extension(dmenu):
     title = 'Settings'
     is_submenu = True
 
-    def __init__(self):
-        self.load_preferences()
-
-    plugins_index_url = 'https://raw.githubusercontent.com/markjones112358/dmenu-extended-plugins/master/plugins_index.json'
+    download_workers = 32
 
     def rebuild_cache(self):
-        if self.debug:
-            print('Counting items in original cache')
-
-        cacheSize = len(self.cache_load().split("\n"))
-
-        if self.debug:
-            print('Rebuilding the cache...')
-        result = self.cache_regenerate()
-        if self.debug:
-            print('Cache built')
-            print('Counting items in new cache')
-        newSize = len(self.cache_load().split("\n"))
-        if self.debug:
-            print('New cache size = ' + str(newSize))
-        cacheSizeChange = newSize - cacheSize
-        if self.debug:
-            if cacheSizeChange != 0:
-                print('This differs from original by ' + str(cacheSizeChange) + ' items')
-            else:
-                print('Cache size did not change')
-
-        response = []
-
-        if cacheSizeChange != 0:
-            if cacheSizeChange == 1:
-                status = 'one new item was added.'
-            elif cacheSizeChange == -1:
-                status = 'one item was removed.'
-            elif cacheSizeChange > 0:
-                status = str(cacheSizeChange) + ' items were added.'
-            elif cacheSizeChange < 0:
-                status = str(abs(cacheSizeChange)) + ' items were removed.'
-            else:
-                status = 'No new items were added'
-
-            response.append('Cache updated successfully; ' + status)
-
-            if result == 2:
-                response.append('NOTICE: Performance issues were encountered while caching data')
-
-        else:
-            response.append('Cache rebuilt; its size did not change.')
-
-        response.append('The cache contains ' + str(cacheSize) + ' items.')
-
-        self.menu(response)
+        self.rebuild_progress(self.cache_rebuild_background())
 
 
     def rebuild_cache_plugin(self):
-        self.plugins_loaded = self.get_plugins(True)
-        self.cache_regenerate()
+        # The rebuild loads the plugins afresh in a process of its own
+        self.rebuild_progress(self.cache_rebuild_background())
 
 
     def download_plugins(self):
         self.message_open('Downloading a list of plugins...')
 
         try:
-            plugins = self.download_json(self.plugins_index_url)
+            plugins = json.loads(self.download_cached(self.prefs['plugins_index_url'],
+                                                      stale=self.prefs['http_stale_while_revalidate']).decode('utf-8'))
         except:
             self.message_close()
             self.menu(["Error: Could not connect to plugin repository.",
@@ -920,17 +4206,16 @@ class extension(dmenu):
         if len(items) == 0:
             self.menu(['There are no new plugins to install'])
         else:
-            item = substitute[0] + self.select(items, 'Install:')
+            item = self.select(items, 'Install:')
 
             if item != -1:
+                item = substitute[0] + item
                 self.message_open("Downloading selected plugin...")
                 plugin_name = item.split(' - ')[0]
-                plugin = plugins[plugin_name]
-                plugin_source = self.download_text(plugin['url'])
-
-                with open(path_plugins + '/' + plugin_name + '.py', 'w') as f:
-                    for line in plugin_source:
-                        f.write(line)
+                if self.plugin_install(plugin_name, plugins[plugin_name]) == False:
+                    self.message_close()
+                    self.menu(['Error: The plugin could not be downloaded or failed verification.'])
+                    sys.exit()
 
                 self.get_plugins(True)
                 self.message_close()
@@ -977,42 +4262,88 @@ class extension(dmenu):
                 print('Selection was not understood')
 
 
+    def plugin_install(self, name, entry, fallback=True):
+        """ Downloads the plugin described by its plugin index entry and,
+        if it matches the sha1sum given there, moves it into place
+
+        The plugin is written to a temporary file beside its destination
+        and renamed over it, so a plugin is never seen half written.
+        Unless fallback is set, a cached copy is not used when the server
+        cannot be reached. Returns True when the plugin was installed.
+        """
+
+        try:
+            source = self.download_cached(entry['url'], 0, fallback=fallback)
+        except Exception as e:
+            if self.debug:
+                print('Could not download ' + name + ': ' + str(e))
+            return False
+        sha = hashlib.sha1(source).hexdigest()
+        if 'sha1sum' in entry and sha != entry['sha1sum']:
+            if self.debug:
+                print('Downloaded version of ' + name + ' does not verify against package manager sha1sum key')
+                print('SHA1SUM of downloaded version = ' + sha)
+                print('SHA1SUM specified by package manager = ' + entry['sha1sum'])
+                print('Plugin not updated')
+            return False
+
+        handle, path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=path_plugins)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(source)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(path, 0o644)
+            os.rename(path, path_plugins + '/' + name + '.py')
+        except:
+            os.remove(path)
+            raise
+        if self.debug:
+            print('Installed ' + name)
+        return True
+
+
     def update_plugins(self):
         self.message_open('Checking for plugin updates...')
-        plugins_here = list(map(lambda x: x['filename'].split('.')[0], self.get_plugins()))
-        plugins_here.remove('plugin_settings')
-        plugins_there = self.download_json(self.plugins_index_url)
-        updated = []
-        for here in plugins_here:
-            for there in plugins_there:
-                if there == here:
-                    there_sha = plugins_there[there]['sha1sum']
-                    here_sha = self.command_output("sha1sum " + path_plugins + '/' + here + '.py')[0].split()[0]
+        plugins_here = [x['filename'].split('.')[0] for x in self.get_plugins()
+                        if x['filename'] != 'plugin_settings.py']
+        pool = ThreadPool(self.download_workers)
+        try:
+            # The installed plugins are hashed while the index downloads.
+            # Updates are only checked against the index as it is now, so
+            # being offline is reported rather than answered from the cache.
+            index = pool.apply_async(self.download_cached, (self.prefs['plugins_index_url'], 0),
+                                     {'fallback': False})
+            hashes = {}
+            for here in plugins_here:
+                hashes[here] = sha1_file(path_plugins + '/' + here + '.py')
+            try:
+                plugins_there = json.loads(index.get().decode('utf-8'))
+            except:
+                self.message_close()
+                self.menu(["Error: Could not connect to plugin repository.",
+                           "Please check your internet connection and try again."])
+                sys.exit()
+
+            stale = []
+            for here in plugins_here:
+                if here in plugins_there:
                     if self.debug:
                         print('Checking ' + here)
-                        print('Local copy has sha of ' + here_sha)
-                        print('Remote copy has sha of ' + there_sha)
-                    if there_sha != here_sha:
-                        sys.stdout.write("Hashes do not match, updating...\n")
-                        if os.path.exists('/tmp/' + there + '.py'):
-                            os.remove('/tmp/' + there + '.py')
-                        os.system('wget ' + plugins_there[there]['url'] + ' -P /tmp')
-                        download_sha = self.command_output("sha1sum /tmp/" + here + '.py')[0].split()[0]
-                        if download_sha != there_sha:
-                            if self.debug:
-                                print('Downloaded version of ' + there + ' does not verify against package manager sha1sum key')
-                                print('SHA1SUM of downloaded version = ' + download_sha)
-                                print('SHA1SUM specified by package manager = ' + there_sha)
-                                print('Plugin not updated')
-                        else:
-                            os.remove(path_plugins + '/' + here + '.py')
-                            os.system('mv /tmp/' + here + '.py ' + path_plugins + '/' + here + '.py')
-                            if self.debug:
-                                print('Done!')
-                            updated += [here]
-                    else:
-                        if self.debug:
-                            print(here + 'is up-to-date')
+                        print('Local copy has sha of ' + hashes[here])
+                        print('Remote copy has sha of ' + plugins_there[here]['sha1sum'])
+                    if plugins_there[here]['sha1sum'] != hashes[here]:
+                        stale.append(here)
+                    elif self.debug:
+                        print(here + ' is up-to-date')
+
+            installed = pool.map(lambda here: self.plugin_install(here, plugins_there[here], False), stale)
+        finally:
+            pool.close()
+            pool.join()
+        updated = [here for here, done in zip(stale, installed) if done]
+        if len(updated) > 0:
+            self.plugins_available()
         self.message_close()
         if len(updated) == 0:
             self.menu(['There are no new updates for installed plugins'])
@@ -1023,6 +4354,7 @@ class extension(dmenu):
 
 
     def run(self, inputText):
+        self.load_preferences()
         items = ['Rebuild cache',
                  self.prefs['indicator_submenu'] + ' Download new plugins',
                  self.prefs['indicator_submenu'] + ' Remove existing plugins',
@@ -1044,6 +4376,460 @@ class extension(dmenu):
             elif selectedIndex == 4:
                 self.update_plugins()
 
+class inotify(object):
+    """ Minimal ctypes binding to the Linux inotify API """
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.get_errno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(self.get_errno(), 'inotify_init1 failed')
+
+
+    def add_watch(self, path, mask):
+        """ Returns the watch descriptor for path, or -1 on failure """
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(sys.getfilesystemencoding()), mask)
+        if wd < 0 and self.get_errno() == 28:
+            raise OSError(28, 'Out of inotify watches, raise fs.inotify.max_user_watches')
+        return wd
+
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+
+    def read_events(self, timeout=None):
+        """ Returns a list of (wd, mask, cookie, name) tuples, waiting at most
+        timeout seconds for them to arrive.
+        """
+        import select
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if len(ready) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += 16
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, name.decode(sys.getfilesystemencoding(), 'replace')))
+        return events
+
+
+class cache_daemon(object):
+    """ Keeps the cache files up-to-date by watching the file system
+
+    The watch folders, the directories on the path, the .desktop application
+    directories and the plugins directory are watched with inotify. Created
+    and removed files and folders are applied to an in-memory copy of the
+    cache which is written out once the file system has been quiet for
+    daemon_debounce seconds.
+
+    Unlike a build, the daemon holds every file and folder of the watch
+    folders in memory (in files and folders) for as long as it runs.
+    """
+
+    tree_mask = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                 inotify.IN_MOVED_TO | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+                 inotify.IN_ONLYDIR)
+    apps_mask = tree_mask | inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE
+
+    def __init__(self, debug=False):
+        self.d = dmenu()
+        self.d.debug = debug
+        self.debug = debug
+        self.notifier = inotify()
+        self.watches = {}
+        self.watched_paths = {}
+        self.first_change = None
+        self.last_change = None
+
+
+    def watch(self, path, kind):
+        if path in self.watched_paths:
+            return
+        wd = self.notifier.add_watch(path, self.apps_mask if kind != 'tree' else self.tree_mask)
+        if wd >= 0:
+            self.watches[wd] = (path, kind)
+            self.watched_paths[path] = wd
+
+
+    def unwatch_tree(self, path):
+        prefix = os.path.join(path, '')
+        for watched in list(self.watched_paths):
+            if watched == path or watched.startswith(prefix):
+                wd = self.watched_paths.pop(watched)
+                self.watches.pop(wd, None)
+                self.notifier.rm_watch(wd)
+
+
+    def scan_tree(self, roots):
+        """ Scans the given folders, watching each folder before it is
+        listed so that nothing created meanwhile is missed
+        """
+        filenames, foldernames = self.scanner.scan(roots, entries=self.entries)
+        self.files.update(filenames)
+        self.folders.update(foldernames)
+
+
+    def resync(self):
+        """ Rebuilds the in-memory copy of the cache from scratch """
+        self.d.prefs = False
+        self.d.load_preferences()
+        for wd in list(self.watches):
+            self.notifier.rm_watch(wd)
+        self.watches = {}
+        self.watched_paths = {}
+
+        self.d.stats = build_stats()
+        self.scanner = folder_scanner(self.d.prefs, self.debug)
+        self.scanner.entering = lambda path: self.watch(path, 'tree')
+        self.files = set()
+        self.folders = set()
+        filenames, foldernames = self.d.cache_scan_folders(self.scanner)
+        self.entries = self.scanner.entries
+        self.files.update(filenames)
+        self.folders.update(foldernames)
+
+        for path in self.d.system_path():
+            if os.path.isdir(path):
+                self.watch(path, 'apps')
+        for path in self.d.application_paths():
+            self.watch(path, 'apps')
+        self.watch(path_plugins, 'plugins')
+        self.watch(path_prefs, 'prefs')
+
+        self.apps_dirty = True
+        self.plugins_dirty = True
+        self.changed()
+
+
+    def changed(self):
+        now = time.time()
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+
+
+    def admit(self, root, max_entries):
+        """ Counts an item added beneath the watch folder root towards its
+        max_entries, returning False if there is no room for it
+        """
+        if max_entries is None:
+            return True
+        if self.entries.get(root, 0) >= max_entries:
+            if self.debug:
+                print('Not adding to ' + root + ', which has reached its max_entries')
+            return False
+        self.entries[root] = self.entries.get(root, 0) + 1
+        return True
+
+
+    def forget(self, items):
+        """ Stops counting the removed items towards max_entries """
+        if len(self.entries) == 0:
+            return
+        for item in items:
+            root = self.scanner.root_for(item)[0]
+            if root in self.entries:
+                self.entries[root] -= 1
+
+
+    def remove_tree(self, path):
+        prefix = os.path.join(path, '')
+        removed = [x for x in self.files if x.startswith(prefix)]
+        removed += [x for x in self.folders if x.startswith(prefix)]
+        self.forget(removed)
+        self.files.difference_update(removed)
+        self.folders.difference_update(removed)
+        self.unwatch_tree(path)
+
+
+    def handle_event(self, wd, mask, name):
+        if mask & inotify.IN_Q_OVERFLOW:
+            if self.debug:
+                print('inotify queue overflowed, rescanning everything')
+            self.resync()
+            return
+        if wd not in self.watches:
+            return
+        root, kind = self.watches[wd]
+
+        if mask & inotify.IN_IGNORED:
+            self.watches.pop(wd, None)
+            self.watched_paths.pop(root, None)
+            return
+
+        if kind == 'apps':
+            self.apps_dirty = True
+        elif kind == 'plugins':
+            self.plugins_dirty = True
+        elif kind == 'prefs':
+            if os.path.join(root, name) == file_prefs and mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+                if self.debug:
+                    print('Preferences changed, rescanning everything')
+                self.resync()
+            return
+        elif mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+            self.remove_tree(root)
+        else:
+            path = os.path.join(root, name)
+            if name in self.scanner.ignore_files:
+                if self.debug:
+                    print('Ignore file ' + path + ' changed, rescanning everything')
+                self.resync()
+                return
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                rules = self.scanner.rules_for(path)
+                watch_root, depth = self.scanner.root_for(path)
+                max_depth, extensions, max_entries, budget = self.scanner.limits.get(watch_root, self.scanner.no_limits)
+                if os.path.isdir(path):
+                    if path in self.scanner.ignore_folders or self.scanner.is_excluded(rules, path, True):
+                        return
+                    if self.scanner.include_hidden_folders or name.startswith('.') == False:
+                        if path + '/' not in self.folders:
+                            if self.admit(watch_root, max_entries) == False:
+                                return
+                            self.folders.add(path + '/')
+                    if self.scanner.scan_hidden_folders == False and name.startswith('.'):
+                        pass
+                    elif max_depth is not None and depth > max_depth:
+                        pass
+                    elif os.path.islink(path) and (self.scanner.follow_symlinks == False or self.scanner.is_loop(root, path)):
+                        pass
+                    else:
+                        self.scan_tree([path])
+                elif self.scanner.valid_file(name, extensions) and self.scanner.is_excluded(rules, path, False) == False:
+                    if path not in self.files and self.admit(watch_root, max_entries):
+                        self.files.add(path)
+            elif path + '/' in self.folders or mask & inotify.IN_ISDIR:
+                self.remove_tree(path)
+            elif path in self.files:
+                self.forget([path])
+                self.files.discard(path)
+        if self.debug:
+            print('Change in ' + root + ' (' + kind + ')')
+        self.changed()
+
+
+    def flush(self):
+        if self.apps_dirty:
+            self.binaries, self.aliased_items, self.aliases = self.d.cache_build_applications()
+            self.apps_dirty = False
+        # Changed plugins are collected by cache_write, within the same
+        # cache_set as the rest of the cache
+        self.d.cache_write(self.binaries, self.aliased_items, self.aliases,
+                           sorted(self.folders), sorted(self.files),
+                           None if self.plugins_dirty else self.plugins)
+        if self.plugins_dirty:
+            plugins = self.d.cache_open(file_cache_plugins)
+            self.plugins = plugins.split('\n')[:-1] if plugins else []
+            self.plugins_dirty = False
+        self.d.stats = build_stats()
+        self.first_change = None
+        self.last_change = None
+        if self.debug:
+            print('Cache written (' + str(len(self.files)) + ' files, ' + str(len(self.folders)) + ' folders)')
+
+
+    def run(self):
+        self.resync()
+        debounce = float(self.d.prefs['daemon_debounce'])
+        while True:
+            if self.last_change is None:
+                timeout = None
+            else:
+                timeout = max(0, min(self.last_change + debounce, self.first_change + 5 * debounce) - time.time())
+            for wd, mask, cookie, name in self.notifier.read_events(timeout):
+                self.handle_event(wd, mask, name)
+            if self.last_change is not None:
+                now = time.time()
+                if now - self.last_change >= debounce or now - self.first_change >= 5 * debounce:
+                    self.flush()
+
+
+def run_profile(debug=False):
+    """ Rebuilds the cache and prints where the time went """
+    d = dmenu()
+    d.debug = debug
+    d.cache_build()
+    print('\n'.join(d.stats.report()))
+    print('Statistics written to ' + file_cache_stats)
+
+
+def run_rebuild(debug=False):
+    """ Rebuilds the cache at a low priority, reporting its progress to the
+    status file
+    """
+    d = dmenu()
+    d.debug = debug
+    d.load_preferences()
+    os.nice(int(d.prefs['rebuild_niceness']))
+    previous = d.load_json(file_cache_stats) or {}
+    d.progress = rebuild_status()
+    d.progress.update(True, state='running', pid=os.getpid(), started=time.time(),
+                      stage='starting', root=None, folders=0, files=0,
+                      expected_folders=previous.get('counters', {}).get('folders scanned'),
+                      expected_seconds=previous.get('seconds'))
+    try:
+        summary = d.cache_rebuild()
+    except Exception as e:
+        d.progress.update(True, state='failed', finished=time.time(), error=str(e))
+        raise
+    d.progress.update(True, state='done', finished=time.time(), summary=summary)
+
+
+def run_daemon(debug=False):
+    daemon = cache_daemon(debug)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+
+class launcher_server(object):
+    """ Keeps the preferences, plugins and cache in memory and opens the
+    menu whenever dmenu_extended_client asks for it.
+
+    Each request is served by a forked child, which inherits everything
+    already loaded, so a launch costs no more than a fork. The files backing
+    the in-memory copies are checked before every request and reloaded when
+    they have changed.
+    """
+
+    # The variables of the client's environment the menu and the programs
+    # it launches are run with, in place of the server's
+    client_environment = ['DISPLAY', 'WAYLAND_DISPLAY', 'XAUTHORITY', 'PATH', 'LANG', 'LANGUAGE',
+                          'LC_ALL', 'LC_CTYPE', 'LC_MESSAGES', 'DBUS_SESSION_BUS_ADDRESS',
+                          'XDG_CURRENT_DESKTOP', 'XDG_SESSION_TYPE', 'XDG_SESSION_DESKTOP',
+                          'DESKTOP_SESSION', 'SSH_AUTH_SOCK', 'TERM']
+
+    def __init__(self, debug=False):
+        self.debug = debug
+        self.d = None
+        self.mtimes = None
+
+
+    def file_mtimes(self):
+        mtimes = []
+        for path in [file_prefs, file_cache_packed, path_plugins]:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+
+    def refresh(self):
+        mtimes = self.file_mtimes()
+        if mtimes != self.mtimes:
+            if self.debug:
+                print('Loading preferences, plugins and cache')
+            self.d = dmenu()
+            self.d.debug = self.debug
+            self.d.load_preferences()
+            self.d.get_plugins(self.mtimes is not None)
+            self.cache = self.d.cache_load_packed()
+            self.mtimes = self.file_mtimes()
+
+
+    def serve(self, connection):
+        request = json.loads(connection.makefile('rb').readline().decode('utf-8'))
+        env = request.get('env', {})
+        for name in self.client_environment:
+            if name in env:
+                os.environ[name] = env[name]
+            elif name in os.environ:
+                del os.environ[name]
+
+        def menu_opened():
+            latency = time.time() - request['started']
+            connection.sendall((json.dumps({'latency': latency}) + '\n').encode('utf-8'))
+            connection.close()
+            if self.debug:
+                print('Menu opened ' + str(round(latency * 1000, 2)) + 'ms after the key press')
+
+        self.d.menu_callback = menu_opened
+        try:
+            run(self.debug or request.get('debug', False), self.d, self.cache, request['started'])
+        finally:
+            # Children leave with os._exit, which skips atexit
+            if self.d.trace is not None:
+                self.d.trace.save()
+
+
+    def run(self):
+        if os.path.exists(file_server_socket):
+            os.remove(file_server_socket)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Created private to the user, so nobody else can connect
+        umask = os.umask(0o077)
+        try:
+            listener.bind(file_server_socket)
+        finally:
+            os.umask(umask)
+        listener.listen(8)
+
+        # Children are never waited for, let the kernel reap them
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        if self.debug:
+            print('Listening on ' + file_server_socket)
+        try:
+            while True:
+                connection = listener.accept()[0]
+                self.refresh()
+                if os.fork() == 0:
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    listener.close()
+                    code = 0
+                    try:
+                        self.serve(connection)
+                    except SystemExit as e:
+                        code = e.code if isinstance(e.code, int) else 0
+                    except Exception as e:
+                        if self.debug:
+                            print('Error while serving a request: ' + str(e))
+                        code = 1
+                    sys.stdout.flush()
+                    os._exit(code)
+                connection.close()
+        finally:
+            listener.close()
+            if os.path.exists(file_server_socket):
+                os.remove(file_server_socket)
+
+
+def run_server(debug=False):
+    try:
+        launcher_server(debug).run()
+    except KeyboardInterrupt:
+        pass
+
+
 def is_binary(d, path):
     if os.path.isfile(path) == False:
         return False
@@ -1088,7 +4874,7 @@ def handle_command(d, out):
             if d.debug:
                 print("Item contained spaces so is likely a binary acting on x")
             parts = out.split(' ')
-            if parts[0] in d.scan_binaries():
+            if d.has_binary(parts[0]):
                 if d.debug:
                     print("Found the binary, executing the command")
                 d.execute(out)
@@ -1114,30 +4900,58 @@ def handle_command(d, out):
         d.execute(out)
 
 
-def run(debug=False):
-    d = dmenu()
+def run(debug=False, d=None, cache=None, started=None):
+    """ Shows the menu and handles the selection
+
+    An already prepared dmenu instance and cache may be passed in, which is
+    how the launcher server avoids loading them on every launch. started is
+    the time of the key press, when known.
+    """
+    if d is None:
+        d = dmenu()
     if debug:
         d.debug = True
-    cache = d.cache_load()
+    d.load_preferences()
+    if d.prefs['trace_launches'] or os.environ.get('DMENU_EXTENDED_TRACE', '') not in ['', '0']:
+        d.trace = launch_trace(started, int(d.prefs['trace_samples']))
+        d.trace.mark('preferences')
+        atexit.register(d.trace.save)
+    if cache is None:
+        cache = d.cache_load_packed()
+    d.cache_overlay(cache)
+    cache.promote(d.history_top())
+    if d.trace is not None:
+        d.trace.mark('cache read')
     out = d.menu(cache,'Open:').strip()
     if len(out) > 0:
         if debug:
             print("Menu closed with user input: " + out)
         # Check if the action relates to a plugin
-        plugins = load_plugins(debug)
-        plugin_hook = False
-        for plugin in plugins:
-            if hasattr(plugin['plugin'], 'is_submenu') and plugin['plugin'].is_submenu == True:
-                pluginTitle = d.prefs['indicator_submenu'] + ' ' + plugin['plugin'].title.strip()
+        plugin_match = False
+        for plugin in d.plugins_manifest():
+            if plugin['is_submenu']:
+                title = d.prefs['indicator_submenu'] + ' ' + plugin['title'].strip()
             else:
-                pluginTitle = plugin['plugin'].title.strip()
+                title = plugin['title'].strip()
+
+            if out[:len(title)] == title:
+                plugin_match = plugin
+                pluginTitle = title
+
+        # Only the plugin selected is imported, in a worker of its own
+        plugin_hook = False
+        if plugin_match != False:
+            plugin_hook = plugin_match['filename']
 
-            if out[:len(pluginTitle)] == pluginTitle:
-                plugin_hook = plugin["plugin"]
+        # Store modifications are not launches
+        if plugin_hook != False or out[0] not in "+-":
+            d.history_record(out, cache)
+        if d.trace is not None:
+            d.trace.mark('plugin match')
 
         # Check for plugin call
         if plugin_hook != False:
-            plugin_hook.run(out[len(pluginTitle):])
+            d.plugin_run(plugin_hook, out[len(pluginTitle):])
             if d.debug:
                 print("This command refers to a plugin")
         else:
@@ -1146,6 +4960,8 @@ def run(debug=False):
             # Check to see if the command begins with the alias indicator
             if out[0:len(d.prefs['indicator_alias'])] == d.prefs['indicator_alias']:
                 out = d.retrieve_aliased_command(out)
+                if d.trace is not None:
+                    d.trace.mark('alias lookup')
                 if d.debug:
                     print("An aliased command was called")
                     print("The command was swapped out for: " + str(out))
@@ -1206,13 +5022,9 @@ def run(debug=False):
                         d.prefs['include_items'].append(item)
                         # Add the item to the alias lookup file
                         if aliased:
-                            aliases = d.load_json(file_cache_aliasesLookup)
-                            if item not in aliases:
-                                aliases.append([
-                                    d.prefs['indicator_alias'] + ' ' + item[0],
-                                    item[1]
-                                ])
-                                d.save_json(file_cache_aliasesLookup, aliases)
+                            store = alias_store()
+                            store.set(d.prefs['indicator_alias'] + ' ' + item[0], item[1])
+                            store.close()
                     elif action == '-':
                         if aliased:
                             to_remove = None
@@ -1224,6 +5036,9 @@ def run(debug=False):
                                     print("Item found and is")
                                     print(to_remove)
                                 d.prefs['include_items'].remove(to_remove)
+                                store = alias_store()
+                                store.remove(d.prefs['indicator_alias'] + ' ' + to_remove[0])
+                                store.close()
                             else:
                                 if d.debug:
                                     print("Couldn't remove the item (item could not be located)")
@@ -1236,26 +5051,21 @@ def run(debug=False):
 
                     d.save_preferences()
 
-                    # Recreate the cache
+                    # Record the edit in the store log rather than rewriting the cache
 
-                    cache_scanned = d.cache_open(file_cache)[:-1]
-
-                    if cache_scanned == False:
+                    if os.path.exists(file_cache) == False:
                         d.cache_regenerate()
                         d.message_close()
                         sys.exit()
-                    else:
-                        cache_scanned = cache_scanned.split("\n")
 
                     if action == '+':
                         if d.debug:
                             print("Adding item to store: " + out)
                         d.message_open("Adding item to store: " + out)
                         if aliased:
-                            cache_scanned = [d.prefs['indicator_alias'] + ' ' + out] + cache_scanned
+                            d.store_log_append('+', d.prefs['indicator_alias'] + ' ' + out)
                         else:
-                            cache_scanned = [out] + cache_scanned
-                        cache_scanned.sort(key=len)
+                            d.store_log_append('+', out)
                     else:
                         if aliased:
                             to_remove = d.prefs['indicator_alias'] + ' ' + out
@@ -1264,15 +5074,7 @@ def run(debug=False):
                         else:
                             to_remove = out
                         d.message_open("Removing item from store: " + to_remove)
-                        try:
-                            cache_scanned.remove(to_remove)
-                        except ValueError:
-                            if d.debug:
-                                print("Couldnt actually remove item from the cache")
-                            else:
-                                pass
-
-                    d.cache_save(cache_scanned, file_cache)
+                        d.store_log_append('-', to_remove)
 
                     d.message_close()
                     if action == '+':
@@ -1300,8 +5102,8 @@ def run(debug=False):
 
                 run_withshell = False
                 shell_hold = False
-                if cmds[0][-1] == ';':
-                    if cmds[0][-2] == ';':
+                if cmds[0][-1:] == ';':
+                    if cmds[0][-2:-1] == ';':
                         shell_hold = True
                         if d.debug:
                             print('Will hold')
@@ -1312,17 +5114,14 @@ def run(debug=False):
                     run_withshell = True
 
                 if cmds[0] == '':
-                    items = list(filter(lambda x: x.find(cmds[1]) != -1, cache.split('\n')))
+                    items = d.cache_filter(cache, cmds[1])
                     item = d.menu(items)
                     handle_command(d, item)
-                elif cmds[0] in d.scan_binaries():
+                elif d.has_binary(cmds[0]):
                     if d.debug:
                         print('Item[0] (' + cmds[0] + ') found in binaries')
-                    # Get paths from cache
-                    items = list(filter(lambda x: x.find('/') != -1, cache.split('\n')))
-                    # If extension passed, filter by this
-                    if cmds[1] != '':
-                        items = list(filter(lambda x: x.find(cmds[1]) != -1, items))
+                    # Get paths from cache, filtered by the extension if one was passed
+                    items = d.cache_filter(cache, cmds[1], [packed_cache.FOLDER, packed_cache.FILE])
                     filename = d.menu(items)
                     filename = os.path.expanduser(filename)
                     command = cmds[0] + " '" + filename + "'"
@@ -1345,13 +5144,8 @@ def run(debug=False):
                 sys.exit()
 
             elif out == "rebuild cache":
-                result = d.cache_regenerate()
-                if result == 0:
-                    d.menu(['Cache could not be saved'])
-                elif result == 2:
-                    d.menu(['Cache rebuilt','Performance issues were detected - some paths contained invalid characters'])
-                else:
-                    d.menu(['Success!'])
+                # Progress is shown instead should a rebuild be running
+                d.rebuild_progress(d.cache_rebuild_background())
 
             else:
                 handle_command(d, out)
@@ -1361,4 +5155,15 @@ if __name__ == "__main__":
     if '--debug' in sys.argv:
         print('Debugging enabled')
         debug = True
-    run(debug)
+    if '--daemon' in sys.argv:
+        run_daemon(debug)
+    elif '--server' in sys.argv:
+        run_server(debug)
+    elif '--profile' in sys.argv:
+        run_profile(debug)
+    elif '--rebuild' in sys.argv:
+        run_rebuild(debug)
+    elif '--trace-report' in sys.argv:
+        print('\n'.join(trace_report()))
+    else:
+        run(debug)
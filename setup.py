@@ -17,5 +17,5 @@ setup(name='dmenu_extended',
       url='https://github.com/markjones112358/dmenu-extended',
       py_modules=['dmenu_extended'],
       # packages=['dmenu_extended', 'dmenu_extended/config', 'dmenu_extended/plugins'],
-      scripts=['dmenu_extended_run']
+      scripts=['dmenu_extended_run', 'dmenu_extended_client']
       )
@@ -0,0 +1,337 @@
+# -*- coding: utf8 -*-
+"""
+Tests of the pooled HTTP client (http_pool) and the plugin updates built on
+it, against a stand-in HTTP server on localhost
+
+Run with:
+
+    python -m unittest discover tests
+"""
+from __future__ import unicode_literals
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# dmenu_extended sets up its files beneath the home folder when imported
+home = tempfile.mkdtemp(prefix='dmenu-extended-test')
+os.environ['HOME'] = home
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+stdout = sys.stdout
+sys.stdout = open(os.devnull, 'w')
+try:
+    import dmenu_extended
+finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+
+
+class stand_in(ThreadingMixIn, HTTPServer):
+    """ Serves the bodies in files by path, with an ETag for each, keeping
+    connections alive and counting the connections and requests made
+
+    A query of delay=seconds holds the response back, redirect=path
+    answers with a redirect and a path not in files gets a 404.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), stand_in_handler)
+        self.files = {}
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:' + str(self.server_address[1]) + path
+
+    def handle_error(self, request, client_address):
+        # Clients that time out leave responses with nowhere to go
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class stand_in_handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, headers, body=b''):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parts = urlparse(self.path)
+        query = parse_qs(parts.query)
+        with self.server.lock:
+            self.server.requests.append((parts.path, self.headers.get('If-None-Match')))
+        if 'delay' in query:
+            time.sleep(float(query['delay'][0]))
+        if 'redirect' in query:
+            return self.respond(302, [('Location', query['redirect'][0])])
+        if parts.path not in self.server.files:
+            return self.respond(404, [])
+        body = self.server.files[parts.path]
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.respond(304, [('ETag', etag)])
+        self.respond(200, [('ETag', etag)], body)
+
+
+class http_pool_test(unittest.TestCase):
+
+    def setUp(self):
+        self.server = stand_in()
+        self.server.files['/a'] = b'first'
+        self.server.files['/b'] = b'second'
+        self.pool = dmenu_extended.http_pool(timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def test_returns_the_body(self):
+        status, headers, body = self.pool.request(self.server.url('/a'))
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'first')
+        self.assertIn('etag', headers)
+
+    def test_reuses_the_connection(self):
+        for path in ['/a', '/b', '/a']:
+            self.pool.request(self.server.url(path))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_follows_redirects(self):
+        body = self.pool.request(self.server.url('/elsewhere?redirect=/b'))[2]
+        self.assertEqual(body, b'second')
+
+    def test_errors_raise(self):
+        self.assertRaises(IOError, self.pool.request, self.server.url('/missing'))
+
+    def test_times_out(self):
+        pool = dmenu_extended.http_pool(timeout=0.2)
+        try:
+            self.assertRaises(Exception, pool.request, self.server.url('/a?delay=1'))
+        finally:
+            pool.close()
+
+    def test_requests_run_concurrently(self):
+        threads = ThreadPool(10)
+        started = time.time()
+        try:
+            bodies = threads.map(lambda i: self.pool.request(self.server.url('/a?delay=0.5'))[2], range(10))
+        finally:
+            threads.close()
+            threads.join()
+        self.assertEqual(bodies, [b'first'] * 10)
+        self.assertLess(time.time() - started, 2)
+
+
+class http_cache_test(unittest.TestCase):
+
+    def setUp(self):
+        self.server = stand_in()
+        self.server.files['/a'] = b'first'
+        self.path = tempfile.mkdtemp(dir=home)
+        self.pool = dmenu_extended.http_pool(timeout=5)
+        self.cache = dmenu_extended.http_cache(self.pool, self.path)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.path, True)
+
+    def go_offline(self):
+        # Kept alive connections would still be served after shutting down
+        self.server.stop()
+        self.server = stand_in()
+        self.pool.close()
+        self.pool = dmenu_extended.http_pool(timeout=5)
+        self.cache = dmenu_extended.http_cache(self.pool, self.path)
+
+    def test_fresh_responses_are_not_requested(self):
+        url = self.server.url('/a')
+        self.assertEqual(self.cache.get(url), b'first')
+        self.assertEqual(self.cache.get(url, max_age=60), b'first')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_revalidates_with_the_etag(self):
+        url = self.server.url('/a')
+        self.cache.get(url)
+        self.assertEqual(self.cache.get(url), b'first')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertIsNotNone(self.server.requests[1][1])
+
+    def test_changes_are_downloaded(self):
+        url = self.server.url('/a')
+        self.cache.get(url)
+        self.server.files['/a'] = b'changed'
+        self.assertEqual(self.cache.get(url), b'changed')
+        self.assertEqual(self.cache.load(url)[1], b'changed')
+
+    def test_stale_responses_revalidate_in_the_background(self):
+        url = self.server.url('/a?delay=0.3')
+        self.cache.get(url)
+        self.server.files['/a'] = b'changed'
+        # The revalidation outlives the process that asked for it
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                if self.cache.get(url, stale=True) == b'first':
+                    code = 0
+            finally:
+                os._exit(code)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.cache.load(url)[1], b'first')
+        waited = 0
+        while self.cache.load(url)[1] != b'changed' and waited < 5:
+            time.sleep(0.05)
+            waited += 0.05
+        self.assertEqual(self.cache.load(url)[1], b'changed')
+
+    def test_falls_back_to_the_cache_offline(self):
+        url = self.server.url('/a')
+        self.cache.get(url)
+        self.go_offline()
+        self.assertEqual(self.cache.get(url), b'first')
+
+    def test_raises_offline_without_fallback(self):
+        url = self.server.url('/a')
+        self.cache.get(url)
+        self.go_offline()
+        self.assertRaises(IOError, self.cache.get, url, fallback=False)
+
+
+class plugin_install_test(unittest.TestCase):
+
+    source = b'import dmenu_extended\n'
+
+    def setUp(self):
+        self.server = stand_in()
+        self.server.files['/plugin_test.py'] = self.source
+        dmenu_extended.dmenu.http = None
+        self.extension = dmenu_extended.extension()
+        self.extension.load_preferences()
+        self.path = dmenu_extended.path_plugins + '/plugin_test.py'
+
+    def tearDown(self):
+        dmenu_extended.dmenu.http = None
+        self.server.stop()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        shutil.rmtree(dmenu_extended.path_cache_http, True)
+
+    def test_installs_a_verified_plugin(self):
+        entry = {'url': self.server.url('/plugin_test.py'),
+                 'sha1sum': hashlib.sha1(self.source).hexdigest()}
+        self.assertTrue(self.extension.plugin_install('plugin_test', entry))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.source)
+
+    def test_refuses_a_plugin_that_does_not_verify(self):
+        entry = {'url': self.server.url('/plugin_test.py'), 'sha1sum': '0' * 40}
+        self.assertFalse(self.extension.plugin_install('plugin_test', entry))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual([x for x in os.listdir(dmenu_extended.path_plugins) if x.endswith('.tmp')], [])
+
+    def test_refuses_a_plugin_that_can_not_be_downloaded(self):
+        entry = {'url': self.server.url('/missing.py'), 'sha1sum': '0' * 40}
+        self.assertFalse(self.extension.plugin_install('plugin_test', entry))
+
+
+class update_plugins_test(unittest.TestCase):
+
+    count = 12
+
+    def setUp(self):
+        self.server = stand_in()
+        dmenu_extended.dmenu.http = None
+        self.extension = dmenu_extended.extension()
+        self.extension.load_preferences()
+        self.extension.download_workers = 4
+        self.names = ['plugin_test' + str(i) for i in range(self.count)]
+        index = {}
+        for name in self.names:
+            source = ('# ' + name + ' updated\n').encode('utf-8')
+            self.server.files['/' + name + '.py'] = source
+            index[name] = {'url': self.server.url('/' + name + '.py'),
+                           'sha1sum': hashlib.sha1(source).hexdigest()}
+            with open(dmenu_extended.path_plugins + '/' + name + '.py', 'wb') as f:
+                f.write(b'# out of date\n')
+        self.server.files['/index.json'] = json.dumps(index).encode('utf-8')
+        self.extension.prefs['plugins_index_url'] = self.server.url('/index.json')
+        # The menu and the loading of the plugins are left out
+        self.shown = []
+        self.extension.menu = lambda items, *args, **kwargs: self.shown.append(items)
+        self.extension.message_open = lambda *args: None
+        self.extension.message_close = lambda *args: None
+        self.extension.plugins_available = lambda *args, **kwargs: []
+        self.extension.get_plugins = lambda *args: [{'filename': x + '.py'} for x in self.names]
+
+    def tearDown(self):
+        dmenu_extended.dmenu.http = None
+        self.server.stop()
+        for name in self.names:
+            os.remove(dmenu_extended.path_plugins + '/' + name + '.py')
+        shutil.rmtree(dmenu_extended.path_cache_http, True)
+
+    def test_updates_share_connections(self):
+        self.extension.update_plugins()
+        self.assertEqual(self.shown[-1], ['The following plugins were updated:'] + self.names)
+        for name in self.names:
+            with open(dmenu_extended.path_plugins + '/' + name + '.py', 'rb') as f:
+                self.assertEqual(f.read(), self.server.files['/' + name + '.py'])
+        # The index and each plugin are requested over no more connections
+        # than there are workers
+        self.assertEqual(len(self.server.requests), self.count + 1)
+        self.assertLessEqual(self.server.connections, self.extension.download_workers)
+        connections = self.server.connections
+
+        # Checking again reuses the connections left open by the first
+        # update, although the workers are new threads
+        self.extension.update_plugins()
+        self.assertEqual(self.shown[-1], ['There are no new updates for installed plugins'])
+        self.assertEqual(self.server.connections, connections)
+
+
+def tearDownModule():
+    shutil.rmtree(home, True)
+
+
+if __name__ == '__main__':
+    unittest.main()